@@ -0,0 +1,159 @@
+from reader import read_file
+from resilience_tracker import check_resilience
+from flow_tracker import check_flow
+from coarse_tracker import check_coarse
+from main import execute_htp
+import os, io, sys, copy, json, time, yaml, argparse, tempfile, platform, resource, contextlib, subprocess
+import multiprocessing as mp
+import numpy as np
+import tifffile
+from scipy import ndimage
+
+stages = ('read_file', 'resilience', 'flow', 'coarse', 'execute_htp')
+
+def synthetic_movie(frames = 64, height = 512, width = 512, channels = 2, dtype = 'uint16', flow = (0.5, 1.0), coarsening = 0.05, noise = 0.02, seed = 0):
+    # [t, y, x, c] movie of a smooth random network that drifts by flow = (dy, dx) pixels per frame and coarsens
+    # (its smoothing length grows by coarsening pixels per frame), with additive noise as a fraction of the range.
+    # Every channel gets its own network, scaled to intensities of about 100 to 6650 as from a 16 bit camera.
+    rng = np.random.default_rng(seed)
+    movie = np.empty((frames, height, width, channels), dtype=dtype)
+    for c in range(channels):
+        field = rng.standard_normal((height, width))
+        for t in range(frames):
+            frame = ndimage.gaussian_filter(field, 2 + coarsening * t, mode='wrap')
+            frame = ndimage.shift(frame, (flow[0] * t, flow[1] * t), order=1, mode='grid-wrap')
+            frame = (frame - frame.mean()) / max(frame.std(), 1e-12)
+            frame = np.clip(0.5 + 0.15 * frame + noise * rng.standard_normal(frame.shape), 0, 1)
+            frame = 100 + frame * 6553.5
+            if np.issubdtype(movie.dtype, np.integer):
+                frame = np.round(frame)
+            movie[t, :, :, c] = frame
+    return movie
+
+def write_movie(movie, path):
+    tifffile.imwrite(path, movie if movie.shape[3] > 1 else movie[..., 0])
+
+def run_stage(stage, movie_path, config_data, conn):
+    # Runs in a fresh process so the peak RSS it reports belongs to this stage alone
+    try:
+        reader_data = config_data['reader']
+        lazy = reader_data.get('lazy_loading', False)
+        correct_bleaching = reader_data.get('bleach_correction', False)
+        with contextlib.redirect_stdout(io.StringIO()):
+            if stage == 'read_file':
+                start = time.perf_counter()
+                file = read_file(movie_path, True, lazy, None, None, correct_bleaching)
+                for t in range(len(file)):
+                    np.asarray(file[t])
+                elapsed = time.perf_counter() - start
+            elif stage == 'execute_htp':
+                start = time.perf_counter()
+                execute_htp(movie_path, config_data)
+                elapsed = time.perf_counter() - start
+            else:
+                # The trackers are timed on a movie already in memory
+                file = np.asarray(read_file(movie_path, True, False, None, None, correct_bleaching))
+                start = time.perf_counter()
+                if stage == 'resilience':
+                    r_data = config_data['resilience_parameters']
+                    pt_loss, pt_gain = r_data['percent_threshold'].values()
+                    f_start, f_stop = r_data['evaluation_settings'].values()
+                    check_resilience(file, 0, r_data['r_offset'], pt_loss, pt_gain, r_data['frame_step'], f_start, f_stop, r_data.get('workers', 1), r_data.get('batch_size', 8), r_data.get('span_step', False))
+                elif stage == 'flow':
+                    f_data = config_data['flow_parameters']
+                    check_flow(file, 0, f_data['min_corr_len'], f_data['min_fraction'], f_data['frame_step'], f_data['downsample'], f_data['pixel_size'], f_data['bin_width'],
+                               backend = f_data.get('flow_backend', 'farneback'), workers = f_data.get('workers', 1), fft_batch = f_data.get('fft_batch', 1))
+                elif stage == 'coarse':
+                    c_data = config_data['coarse_parameters']
+                    first_frame, last_frame = c_data['evaluation_settings'].values()
+                    check_coarse(file, 0, first_frame, last_frame, c_data['threshold_percentage'], c_data.get('series_step', False))
+                elapsed = time.perf_counter() - start
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+        conn.send(('ok', (elapsed, peak_rss)))
+    except Exception as error:
+        conn.send(('error', repr(error)))
+    finally:
+        conn.close()
+
+def time_stage(stage, movie_path, config_data, repeats = 1):
+    # Best time and largest peak RSS (in MB) over `repeats` fresh processes
+    context = mp.get_context('spawn')
+    times, peaks = [], []
+    for _ in range(repeats):
+        recv_conn, send_conn = context.Pipe(duplex=False)
+        process = context.Process(target=run_stage, args=(stage, movie_path, config_data, send_conn))
+        process.start()
+        send_conn.close()
+        status, payload = recv_conn.recv()
+        process.join()
+        if status != 'ok':
+            raise RuntimeError(stage + ' failed: ' + payload)
+        times.append(payload[0])
+        peaks.append(payload[1])
+    return min(times), max(peaks)
+
+def benchmark(config_data, movie_parameters, selected = stages, repeats = 1):
+    # Writes a synthetic movie to a temporary TIFF and times every selected stage on it
+    config_data = copy.deepcopy(config_data)
+    config_data['reader']['verbose'] = False
+    config_data['reader']['channel_select'] = -1
+    config_data.setdefault('cache_parameters', {})['enabled'] = False
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        movie_path = os.path.join(directory, 'synthetic.tif')
+        write_movie(synthetic_movie(**movie_parameters), movie_path)
+        for stage in selected:
+            elapsed, peak_rss = time_stage(stage, movie_path, config_data, repeats)
+            results[stage] = {'seconds': elapsed, 'frames_per_second': movie_parameters['frames'] / max(elapsed, 1e-9), 'peak_rss_mb': peak_rss}
+    return results
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(results, reference = None):
+    print('{:<14}{:>10}{:>12}{:>16}'.format('stage', 'time (s)', 'frames/s', 'peak RSS (MB)') + ('{:>14}'.format('vs reference') if reference else ''))
+    for stage, result in results.items():
+        line = '{:<14}{:>10.2f}{:>12.1f}{:>16.0f}'.format(stage, result['seconds'], result['frames_per_second'], result['peak_rss_mb'])
+        if reference and stage in reference:
+            line += '{:>13.2f}x'.format(reference[stage]['seconds'] / max(result['seconds'], 1e-9))
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the reader, each tracker and the full pipeline on a synthetic movie')
+    parser.add_argument('config_path', nargs='?', default='htp-screening/Scripts/config.yaml')
+    parser.add_argument('--frames', type=int, default=64)
+    parser.add_argument('--size', type=int, nargs=2, default=[512, 512], metavar=('HEIGHT', 'WIDTH'))
+    parser.add_argument('--channels', type=int, default=2)
+    parser.add_argument('--dtype', default='uint16')
+    parser.add_argument('--flow', type=float, nargs=2, default=[0.5, 1.0], metavar=('DY', 'DX'), help='Drift in pixels per frame')
+    parser.add_argument('--coarsening', type=float, default=0.05, help='Growth of the structure size in pixels per frame')
+    parser.add_argument('--stages', nargs='+', choices=stages, default=list(stages))
+    parser.add_argument('--repeats', type=int, default=1, help='Report the best of this many runs of each stage')
+    parser.add_argument('--output', help='Save the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare against')
+    args = parser.parse_args()
+
+    with open(args.config_path, "r") as yamlfile:
+        config_data = yaml.load(yamlfile, Loader=yaml.CLoader)
+    movie_parameters = {'frames': args.frames, 'height': args.size[0], 'width': args.size[1], 'channels': args.channels,
+                        'dtype': args.dtype, 'flow': args.flow, 'coarsening': args.coarsening}
+    results = benchmark(config_data, movie_parameters, args.stages, args.repeats)
+
+    reference = None
+    if args.compare:
+        with open(args.compare) as f:
+            reference = json.load(f)['results']
+    print_results(results, reference)
+
+    if args.output:
+        report = {'revision': git_revision(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                  'numpy': np.__version__, 'cpus': os.cpu_count(), 'movie': movie_parameters, 'results': results}
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,26 @@
+from reader import read_file
+import sys
 import numpy as np
-import matplotlib.pyplot as plt
-import imageio.v3 as iio
 # from numpy.polynomial import Polynomial, polyroots
-from nd2reader import ND2Reader
-from scipy.interpolate import splrep, sproot, BSpline
-import scipy
-from scipy.stats import mode
-import scipy.signal as signal
+from scipy.interpolate import splrep, BSpline
+import scipy.ndimage
+from frame_stats import FrameMemo, intensity_histogram, mean_mode
+
+# Width of the intensity bins compared between frames, in intensity levels of the first frame
+bins_width = 3
+# Number of frames whose histograms are compared with the first frame's at once when deriving the time series
+series_batch = 128
 
 def calculate_mean_mode(frame):
-    mean_intensity = np.mean(frame)
-    mode_intensity = mode(frame.flatten(), keepdims=False).mode
-    return mean_intensity, mode_intensity
-
-def analyze_frames(image, threshold_percentage):
-    first_frame = image[0]
-    last_frame = image[len(image) - 1]
-        
-    # calculate mean and mode for first frame
-    mean_first_frame, mode_first_frame = calculate_mean_mode(first_frame)
-    # calculate mean and mode for last frame
-    mean_last_frame, mode_last_frame = calculate_mean_mode(last_frame)            
+    return mean_mode(frame, intensity_histogram(frame))
+
+def analyze_frames(first_frame, last_frame, threshold_percentage):
+    return coarsening_verdict(calculate_mean_mode(first_frame), calculate_mean_mode(last_frame), threshold_percentage)
+
+def coarsening_verdict(first_mean_mode, last_mean_mode, threshold_percentage):
+    # Takes the (mean, mode) of the first and last frames
+    mean_first_frame, mode_first_frame = first_mean_mode
+    mean_last_frame, mode_last_frame = last_mean_mode
                    
      # Calculate the difference between mean and mode for both frames
     diff_first_frame = abs(mean_first_frame - mode_first_frame)
@@ -35,90 +35,185 @@ def analyze_frames(image, threshold_percentage):
     else:
         return 0
 
-def check_coarse(file, channel, first_frame, last_frame, threshold_percentage):
-    extrema_bounds_list = []
-    extrema_bounds_idx_list = []
-    areas_list = []
-    extrema_len_list = []
-    extrema_height_list = []
-
-    im = file[:,:,:,channel]
-
-    # Set last_frame to last frame of movie if unspecified
-    if last_frame == False: 
-        last_frame = len(im) - 1
-
-    fig, ax = plt.subplots(figsize=(5,5))
-
-    if (im == 0).all(): # If image is blank, then end program early
-        verdict = "Data not available for this channel."
-        return verdict, fig, np.array([])
-
-    max_px_intensity = 1.1*np.max(im)
-    min_px_intensity = np.min(im)
-    bins_width = 3
-    poly_deg = 40
-    poly_len = 10000
+def first_extrema(filtered, comparator):
+    # Value at the first local extremum of every row of filtered (NaN for rows without one)
+    import scipy.signal as signal
+    rows, columns = signal.argrelextrema(filtered, comparator, axis = 1, order = 20)
+    values = np.full(len(filtered), np.nan)
+    found, first = np.unique(rows, return_index=True)
+    values[found] = filtered[found, columns[first]]
+    return values
+
+class CoarseAccumulator:
+    # Consumes a channel one frame at a time, keeping only the frames compared at the end and the running extrema
+    def __init__(self, num_frames, first_frame, last_frame, threshold_percentage, series_step = False, stats = None):
+        # Set last_frame to last frame of movie if unspecified
+        if last_frame == False: 
+            last_frame = num_frames - 1
+        self.num_frames = num_frames
+        self.first_frame = range(num_frames)[first_frame]
+        self.last_frame = range(num_frames)[last_frame]
+        self.threshold_percentage = threshold_percentage
+        self.frames = {}
+        self.min_px_intensity = None
+        self.max_px_intensity = None
+        # Every series_step-th frame from first_frame to last_frame is compared with first_frame as well (not when
+        # False): its mean and mode, and its intensity histogram scaled to the first frame's mean, are kept as it
+        # streams past and turned into the rows of coarse_series by result()
+        self.series_step = series_step
+        self.series_frames = []
+        self.series_mean_modes = []
+        self.series_counts = []
+        self.coarse_series = []
+        # Per-frame means, extrema and histograms come from the file's FrameMemo when shared with other trackers
+        self.stats = stats if stats is not None else FrameMemo().channel(0)
+
+    def add(self, t, frame):
+        frame_min, frame_max = self.stats.extrema(t, frame)
+        if self.max_px_intensity is None:
+            self.min_px_intensity, self.max_px_intensity = frame_min, frame_max
+        else:
+            self.min_px_intensity = min(self.min_px_intensity, frame_min)
+            self.max_px_intensity = max(self.max_px_intensity, frame_max)
+        if t in (0, self.num_frames - 1, self.first_frame, self.last_frame):
+            self.frames[t] = frame
+        if self.series_step and self.first_frame <= t <= self.last_frame and (t - self.first_frame) % self.series_step == 0:
+            mean_mode = self.stats.mean_mode(t, frame)
+            self.series_frames.append(t)
+            self.series_mean_modes.append(mean_mode)
+            self.series_counts.append(self.scaled_counts(t, frame, self.series_mean_modes[0][0] / mean_mode[0] if mean_mode[0] else 0))
+
+    def scaled_counts(self, t, frame, scale):
+        # Counts of scale * frame in bins of bins_width from 0 (negative values left out), from the frame's integer
+        # intensity histogram when it has one
+        histogram = self.stats.histogram(t, frame)
+        if histogram is None:
+            values, weights = frame.ravel(), None
+        else:
+            low, counts = histogram
+            present = np.flatnonzero(counts)
+            values, weights = present + low, counts[present]
+        bins = np.floor(values * (scale / bins_width))
+        kept = bins >= 0
+        return np.bincount(bins[kept].astype(np.int64), weights=None if weights is None else weights[kept]).astype(np.uint32)
+
+    def density_histogram(self, t, scale, bins):
+        # np.histogram(scale * frame, bins, density=True) counts of frame t, binned from the frame's integer
+        # intensity histogram when it has one (each distinct value is scaled and binned exactly as its pixels are)
+        frame = self.frames[t]
+        histogram = self.stats.histogram(t, frame)
+        if histogram is None:
+            return np.histogram((frame if scale == 1 else scale * frame).flatten(), bins=bins, density=True)[0]
+        low, counts = histogram
+        present = np.flatnonzero(counts)
+        values = (present + low).astype(frame.dtype)
+        return np.histogram(values if scale == 1 else scale * values, bins=bins, weights=counts[present], density=True)[0]
+
+    def result(self):
+        first_frame, last_frame = self.first_frame, self.last_frame
+        threshold_percentage = self.threshold_percentage
+        extrema_bounds_list = []
+        extrema_bounds_idx_list = []
+        areas_list = []
+        extrema_len_list = []
+        extrema_height_list = []
+
+        if self.min_px_intensity == 0 and self.max_px_intensity == 0: # If image is blank, then end program early
+            verdict = "Data not available for this channel."
+            return verdict, None, np.array([])
+
+        max_px_intensity = 1.1*self.max_px_intensity
+        min_px_intensity = self.min_px_intensity
+        poly_deg = 40
+        poly_len = 10000
     
-    near_zero_limit = 0.01
-    minimum_area = 0.010
+        near_zero_limit = 0.01
+        minimum_area = 0.010
     
-    i_frame_data = im[first_frame]
-    f_frame_data = im[last_frame]
-    print(i_frame_data, f_frame_data)
-    f_norm = np.mean(i_frame_data) / np.mean(f_frame_data)
-    print(f_norm)
-    f_frame_data = f_norm * f_frame_data
-
-    fig, ax = plt.subplots(figsize=(5,5))
-    set_bins = np.arange(0, max_px_intensity, f_norm * bins_width)
-    bins_num = len(set_bins)
-    i_count, bins = np.histogram(i_frame_data.flatten(), bins=set_bins, density=True)
-    f_count, bins = np.histogram(f_frame_data.flatten(), bins=set_bins, density=True)
-    center_bins = (bins[1] - bins[0])/2
-    plt_bins = bins[0:-1] + center_bins
-    ax.plot(plt_bins, i_count, '^-', ms=4, c='darkred', alpha=0.2, label= "frame " + str(first_frame+1)+" dist")
-    ax.plot(plt_bins, f_count, 'v-', ms=4, c='darkorange',   alpha=0.2, label= "frame " + str(last_frame+1)+" dist")
+        i_frame_data = self.frames[first_frame]
+        f_frame_data = self.frames[last_frame]
+        print(i_frame_data, f_frame_data)
+        f_norm = self.stats.mean(first_frame, i_frame_data) / self.stats.mean(last_frame, f_frame_data)
+        print(f_norm)
+
+        set_bins = np.arange(0, max_px_intensity, f_norm * bins_width)
+        bins_num = len(set_bins)
+        i_count = self.density_histogram(first_frame, 1, set_bins)
+        f_count = self.density_histogram(last_frame, f_norm, set_bins)
+        bins = set_bins
+        center_bins = (bins[1] - bins[0])/2
+        plt_bins = bins[0:-1] + center_bins
     
-    count_diff = f_count - i_count
-    ax.plot(plt_bins, count_diff, 'D-', ms=2, c='red', label = "difference btwn")
+        count_diff = f_count - i_count
     
-    p_cutoff = 1e-5
-    initial_spline = splrep(plt_bins, i_count, s = 0.00005)
-    in_cutoff = np.max(np.where(BSpline(*initial_spline)(plt_bins) >= p_cutoff))
-    ax.axvline(x = in_cutoff)
-    minimum_area = 0.01 * float(BSpline.basis_element(initial_spline[0]).integrate(0, in_cutoff))
-
-    ax.plot(plt_bins, i_count, '^-', ms=4, c='darkred', alpha=0.2, label= "frame " + str(first_frame+1)+" dist")
-    ax.plot(plt_bins, f_count, 'v-', ms=4, c='darkorange',   alpha=0.2, label= "frame " + str(last_frame+1)+" dist")
-    count_diff = f_count - i_count
-    ax.plot(plt_bins, count_diff, 'D-', ms=2, c='red', label = "difference btwn")
-    ax.plot(plt_bins, BSpline(*initial_spline)(plt_bins), c='magenta', label='initial_fit')
+        p_cutoff = 1e-5
+        initial_spline = splrep(plt_bins, i_count, s = 0.00005)
+        in_cutoff = np.max(np.where(BSpline(*initial_spline)(plt_bins) >= p_cutoff))
+        minimum_area = 0.01 * float(BSpline.basis_element(initial_spline[0]).integrate(0, in_cutoff))
     
-    
-    # ### get range for local extrema of interest ###
+        # ### get range for local extrema of interest ###
 
-    cumulative_count_diff = np.cumsum(count_diff)
-    filtered_ccd = scipy.ndimage.gaussian_filter1d(cumulative_count_diff, 8)
-    ax.plot(filtered_ccd, c = 'darkgreen', label = 'CDF')
+        cumulative_count_diff = np.cumsum(count_diff)
+        filtered_ccd = scipy.ndimage.gaussian_filter1d(cumulative_count_diff, 8)
+        plot_data = {'bins': plt_bins, 'first_counts': i_count, 'last_counts': f_count, 'difference': count_diff,
+                     'initial_fit': BSpline(*initial_spline)(plt_bins), 'cutoff': in_cutoff, 'cumulative': filtered_ccd.copy(),
+                     'first_frame': first_frame, 'last_frame': last_frame, 'max_intensity': max_px_intensity}
     
-    peaks_max = signal.argrelextrema(filtered_ccd, np.greater, order = 20)
-    peaks_min = signal.argrelextrema(filtered_ccd, np.less, order = 20)
-    if len(filtered_ccd[peaks_max]) == 0:
-        filtered_ccd[peaks_max] = np.array([0])
-    if len(filtered_ccd[peaks_min]) == 0:
-        filtered_ccd[peaks_min] = np.array([0])
-    areas = np.append(np.abs(filtered_ccd[peaks_max][0]), np.abs(filtered_ccd[peaks_max][0] - filtered_ccd[peaks_min][0]))
-
-    verdict = analyze_frames(im, threshold_percentage)
-
-    ax.axhline(0, color='dimgray', alpha=0.6)
-    ax.set_xlabel("Pixel intensity value")
-    ax.set_ylabel("Probability")
-    ax.set_xlim(0,max_px_intensity + 5)
-    ax.legend()
+        import scipy.signal as signal
+        peaks_max = signal.argrelextrema(filtered_ccd, np.greater, order = 20)
+        peaks_min = signal.argrelextrema(filtered_ccd, np.less, order = 20)
+        if len(filtered_ccd[peaks_max]) == 0:
+            filtered_ccd[peaks_max] = np.array([0])
+        if len(filtered_ccd[peaks_min]) == 0:
+            filtered_ccd[peaks_min] = np.array([0])
+        areas = np.append(np.abs(filtered_ccd[peaks_max][0]), np.abs(filtered_ccd[peaks_max][0] - filtered_ccd[peaks_min][0]))
+
+        last = self.num_frames - 1
+        verdict = coarsening_verdict(self.stats.mean_mode(0, self.frames[0]), self.stats.mean_mode(last, self.frames[last]), threshold_percentage)
+
+        if self.series_counts:
+            self.coarse_series = self.series(max_px_intensity)
     
-    return verdict, fig, areas
+        return verdict, plot_data, areas
+
+    def series(self, max_px_intensity):
+        # Rows of [frame, mean, mode, mean-mode gap, gap increase over first_frame (%), coarsening, peak area,
+        # peak to trough area]: the verdict and the cumulative difference areas of comparing every sampled frame
+        # with first_frame. Unlike the two-frame comparison, whose bins are fixed in the last frame's intensity
+        # scale, every frame is binned in the first frame's, so that all of them share the same (frames, bins)
+        # grid and are compared in batches of series_batch frames.
+        num_bins = len(np.arange(0, max_px_intensity, bins_width)) - 1
+        def densities(counts):
+            block = np.zeros((len(counts), num_bins))
+            for row, row_counts in zip(block, counts):
+                row[:min(len(row_counts), num_bins)] = row_counts[:num_bins]
+            totals = block.sum(axis=1, keepdims=True)
+            return block / (np.where(totals > 0, totals, 1) * bins_width)
+
+        first_counts = densities(self.series_counts[:1])
+        peak_areas, trough_areas = [], []
+        for start in range(0, len(self.series_counts), series_batch):
+            cumulative = np.cumsum(densities(self.series_counts[start:start + series_batch]) - first_counts, axis=1)
+            filtered = scipy.ndimage.gaussian_filter1d(cumulative, 8, axis=1)
+            peaks_max = first_extrema(filtered, np.greater)
+            peaks_min = first_extrema(filtered, np.less)
+            peak_areas.append(np.abs(peaks_max))
+            trough_areas.append(np.abs(peaks_max - peaks_min))
+        peak_areas, trough_areas = np.concatenate(peak_areas), np.concatenate(trough_areas)
+
+        means, modes = np.array(self.series_mean_modes, dtype=np.float64).T
+        gaps = np.abs(means - modes)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            increases = (gaps - gaps[0]) / gaps[0] * 100
+        return [[t, mean, mode, gap, increase, int(increase > self.threshold_percentage), peak, trough]
+                for t, mean, mode, gap, increase, peak, trough in zip(self.series_frames, means, modes, gaps, increases, peak_areas, trough_areas)]
+
+def check_coarse(file, channel, first_frame, last_frame, threshold_percentage, series_step = False):
+    im = file[:,:,:,channel]
+    accumulator = CoarseAccumulator(len(im), first_frame, last_frame, threshold_percentage, series_step)
+    for t in range(len(im)):
+        accumulator.add(t, im[t])
+    return accumulator.result()
 
 def main():
     file = read_file(sys.argv[1])
@@ -0,0 +1,42 @@
+from reader import read_file
+from flow_tracker import FlowAccumulator, flow_backends
+import sys, time, argparse, yaml
+import numpy as np
+
+# Runs every optical flow backend over the same channel of a movie and reports runtime and correlation lengths
+def benchmark_backends(file, channel, flow_data, frames = None):
+    images = file[:,:,:,channel]
+    num_frames = len(images) if frames == None else min(frames, len(images))
+    results = {}
+    for backend in flow_backends:
+        accumulator = FlowAccumulator(num_frames, images.shape[1:3], flow_data['min_corr_len'], flow_data['min_fraction'], flow_data['frame_step'], flow_data['downsample'], flow_data['pixel_size'], flow_data['bin_width'], backend = backend)
+        start = time.perf_counter()
+        for t in range(num_frames):
+            accumulator.add(t, images[t])
+        verdict, plot_data = accumulator.result()
+        elapsed = time.perf_counter() - start
+        results[backend] = (elapsed, len(accumulator.corrLens), accumulator.corrLens, verdict)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare optical flow backends on one movie')
+    parser.add_argument('file_path')
+    parser.add_argument('config_path', nargs='?', default='htp-screening/Scripts/config.yaml')
+    parser.add_argument('--channel', type=int, default=0)
+    parser.add_argument('--frames', type=int, help='Only use the first N frames')
+    args = parser.parse_args()
+
+    with open(args.config_path, "r") as yamlfile:
+        config_data = yaml.load(yamlfile, Loader=yaml.CLoader)
+    file = read_file(args.file_path, True, True)
+    if file is None:
+        sys.exit("Please input valid file type ('.nd2', '.tiff', '.tif')")
+
+    results = benchmark_backends(file, args.channel, config_data['flow_parameters'], args.frames)
+    reference = results['farneback'][2]
+    print('{:<20}{:>10}{:>12}{:>16}{:>20}{:>9}'.format('backend', 'time (s)', 'pairs/s', 'mean corr len', 'mean |diff| vs fb', 'verdict'))
+    for backend, (elapsed, pairs, corrLens, verdict) in results.items():
+        print('{:<20}{:>10.2f}{:>12.2f}{:>16.2f}{:>20.2f}{:>9}'.format(backend, elapsed, pairs / max(elapsed, 1e-9), corrLens.mean(), np.abs(corrLens - reference).mean(), str(verdict)))
+
+if __name__ == "__main__":
+    main()
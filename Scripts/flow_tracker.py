@@ -1,108 +1,261 @@
-from reader import read_file
 import numpy as np
-import matplotlib.pyplot as plt
-import cv2 as cv
-from scipy.fft import fft2, ifft2
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from scipy.fft import rfft2, irfft2
 from scipy.interpolate import Akima1DInterpolator
 from scipy import optimize
+from kernels import normal_vectors, radial_sums
 
 #Find the first point at which a spline interpolant for a set of correlator values descends below a certain threshold
 def findRoot(xValues, yValues,threshold):
     interpolator = Akima1DInterpolator(xValues, yValues)
     return optimize.root_scalar(lambda arg: interpolator([arg])[0]-threshold ,bracket=[min(xValues),max(xValues)]).root
 
-def check_flow(file, name, channel, min_corr_len, min_fraction, frame_stride, downsample, pix_size, bin_width, decay_threshold = 1/np.exp(1)):
-    #Width of annuli in pixels
-    pixel_bin_width = np.ceil(bin_width / pix_size)
-    #Length at which to stop computing correlators
-    max_len = 500
-    #Length in pixels at which to cut off correlators
-    max_pixel_len = np.rint(max_len / pix_size)
-    #Cutoff magnitude to consider a vector to be null; also helps to avoid divide-by-zero errors
-    flt_tol = 1e-10
-
-    fig, ax = plt.subplots(figsize=(5,5))
-
-    def normalVectors(velocities):
-        #Find velocity directions
-        def normalize(vector):
-            magnitude = np.linalg.norm(vector)
-            if magnitude == 0: return np.array([0,0])
-            return np.where(magnitude > flt_tol, np.array(vector)/magnitude, np.array([0, 0]))
-                
-        normals = np.zeros_like(velocities)
-        for i in range(0, velocities.shape[0]):
-            for j in range(0, velocities.shape[1]):
-                normals[i][j] = normalize(velocities[i][j])
-    
-        return normals
+#Assign each point of a radius grid to the annulus of width pixel_bin_width centred on a multiple of it (points
+#exactly half way between two centres belong to neither); returns the flat bin index of every point (-1 when
+#outside all annuli), the number of points per annulus and the annulus centres
+def radialBins(radii, max_pixel_len, pixel_bin_width):
+    centres = np.arange(0, int(max_pixel_len), int(pixel_bin_width))
+    bins = np.rint(radii / pixel_bin_width).astype(np.int64)
+    inside = (bins < len(centres)) & (np.abs(radii - bins * pixel_bin_width) < .5*pixel_bin_width)
+    bins = np.where(inside, bins, -1).ravel()
+    counts = np.bincount(bins[bins >= 0], minlength=len(centres))
+    return bins, counts, centres
 
+#Normalised mean of a correlator over every non-empty annulus
+def radialMeans(convSum, bins, counts):
+    sums = radial_sums(convSum, bins, len(counts))
+    nonempty = counts > 0
+    return sums[nonempty] / counts[nonempty] / convSum[0,0]
+
+#Optical flow backends: each takes a pair of frames and returns the (x, y) displacement, in full resolution pixels,
+#at the points of the grid np.arange(0, height, downsample) x np.arange(0, width, downsample). OpenCV is only
+#imported once a backend that uses it runs.
+
+#Frames are passed to OpenCV as they are when it takes their dtype without loss, otherwise in float32 (which
+#OpenCV computes in anyway); int64 frames, for one, are not accepted at all
+def cvImage(frame):
+    return frame if frame.dtype in (np.uint8, np.uint16, np.float32) else np.float32(frame)
+
+#Dense Farneback flow at full resolution, subsampled afterwards
+def farnebackFlow(first, second, downsample):
+    import cv2 as cv
+    flow = cv.calcOpticalFlowFarneback(cvImage(first), cvImage(second), None, 0.5, 3, 20, 3, 5, 1.2, 0)
+    return flow[::downsample, ::downsample]
+
+#Farneback flow computed directly on frames block-averaged down to the sampling grid
+def pyramidFarnebackFlow(first, second, downsample):
+    import cv2 as cv
+    if downsample == 1:
+        return farnebackFlow(first, second, downsample)
+    size = (-(-first.shape[1] // downsample), -(-first.shape[0] // downsample))
+    small = [cv.resize(np.float32(frame), size, interpolation=cv.INTER_AREA) for frame in (first, second)]
+    winsize = max(5, int(round(20 / downsample)) | 1)
+    flow = cv.calcOpticalFlowFarneback(small[0], small[1], None, 0.5, 3, winsize, 3, 5, 1.2, 0)
+    return flow * downsample
+
+#DIS optical flow (8-bit input, so both frames are scaled to a shared intensity range)
+def disFlow(first, second, downsample):
+    import cv2 as cv
+    low = min(np.min(first), np.min(second))
+    scale = 255 / max(float(max(np.max(first), np.max(second))) - low, 1e-10)
+    first, second = [np.uint8(np.clip((np.float32(frame) - low) * scale, 0, 255)) for frame in (first, second)]
+    dis = cv.DISOpticalFlow_create(cv.DISOPTICAL_FLOW_PRESET_MEDIUM)
+    return dis.calc(first, second, None)[::downsample, ::downsample]
+
+#Block matching by FFT phase correlation of a window centred on every grid point, with parabolic subpixel refinement.
+#Blocks are at least 32 pixels and 4 grid spacings wide: in smaller ones the Hann window dominates the correlation
+#surface and pulls most peaks to zero displacement.
+def phaseCorrelationFlow(first, second, downsample, block = 32, chunk_rows = 32):
+    block = max(block, 4 * downsample)
+    window = np.outer(np.hanning(block), np.hanning(block)).astype(np.float32)
+    rows, cols = -(-first.shape[0] // downsample), -(-first.shape[1] // downsample)
+    windows = []
+    for frame in (first, second):
+        frame = np.pad(np.float32(frame), block // 2, mode='reflect')
+        windows.append(np.lib.stride_tricks.sliding_window_view(frame, (block, block))[::downsample, ::downsample][:rows, :cols])
+
+    flow = np.zeros((rows, cols, 2), dtype=np.float32)
+    for start in range(0, rows, chunk_rows):
+        a, b = [(w[start:start+chunk_rows] - w[start:start+chunk_rows].mean(axis=(-2, -1), keepdims=True)) * window for w in windows]
+        cross = rfft2(b) * np.conjugate(rfft2(a))
+        surface = irfft2(cross / np.maximum(np.abs(cross), 1e-10), s=(block, block))
+        peak_y, peak_x = np.divmod(surface.reshape(surface.shape[:2] + (-1,)).argmax(axis=-1), block)
+        grid_y, grid_x = np.indices(peak_y.shape)
+        def at(dy, dx):
+            return surface[grid_y, grid_x, (peak_y + dy) % block, (peak_x + dx) % block]
+        centre = at(0, 0)
+        for (dy, dx), peak, component in (((0, 1), peak_x, 0), ((1, 0), peak_y, 1)):
+            before, after = at(-dy, -dx), at(dy, dx)
+            curvature = before - 2 * centre + after
+            offset = np.where(np.abs(curvature) > 1e-10, 0.5 * (before - after) / np.where(np.abs(curvature) > 1e-10, curvature, 1), 0)
+            flow[start:start+chunk_rows, :, component] = np.where(peak > block // 2, peak - block, peak) + offset
+    return flow
+
+#Flow of a large frame computed tile by tile: each tile's flow comes from the tile plus a halo of the tiler's overlap
+#around it, and only the grid points inside the tile itself are kept (tiles and halos start on the sampling grid)
+def tiledFlow(backend, first, second, downsample, tiler):
+    flow = np.empty((-(-first.shape[0] // downsample), -(-first.shape[1] // downsample), 2), dtype=np.float32)
+    def tileFlow(tile):
+        (rows, columns), (halo_rows, halo_columns) = tile
+        part = backend(first[halo_rows, halo_columns], second[halo_rows, halo_columns], downsample)
+        top, left = (rows.start - halo_rows.start) // downsample, (columns.start - halo_columns.start) // downsample
+        return tile[0], part[top:top + -(-(rows.stop - rows.start) // downsample), left:left + -(-(columns.stop - columns.start) // downsample)]
+    for (rows, columns), part in tiler.map(tileFlow, tiler.tiles(first.shape, downsample)):
+        flow[rows.start // downsample:rows.start // downsample + part.shape[0], columns.start // downsample:columns.start // downsample + part.shape[1]] = part
+    return flow
+
+flow_backends = {
+    'farneback': farnebackFlow,
+    'farneback_pyramid': pyramidFarnebackFlow,
+    'dis': disFlow,
+    'phase_correlation': phaseCorrelationFlow,
+}
+
+class FlowAccumulator:
+    #Consumes a channel one frame at a time, only keeping the frames still needed to form frame pairs
+    def __init__(self, num_frames, frame_shape, min_corr_len, min_fraction, frame_stride, downsample, pix_size, bin_width, decay_threshold = 1/np.exp(1), backend = 'farneback', workers = 1, fft_batch = 1, tiler = None):
+        if backend not in flow_backends:
+            raise ValueError("Flow backend must be one of: " + ", ".join(flow_backends))
+        self.backend = flow_backends[backend]
+        #Optical flow is computed tile by tile when a tiler is given
+        self.tiler = tiler
+        self.downsample = downsample
+        self.min_corr_len = min_corr_len
+        self.min_fraction = min_fraction
+        self.frame_stride = frame_stride
+        self.pix_size = pix_size
+        self.decay_threshold = decay_threshold
+        #Width of annuli in pixels
+        self.pixel_bin_width = np.ceil(bin_width / pix_size)
+        #Length at which to stop computing correlators
+        max_len = 500
+        #Length in pixels at which to cut off correlators
+        self.max_pixel_len = np.rint(max_len / pix_size)
+        #Cutoff magnitude to consider a vector to be null; also helps to avoid divide-by-zero errors
+        self.flt_tol = 1e-10
+
+        self.positions = np.array([0, int(np.floor(num_frames/2)), num_frames - frame_stride - 1])
+
+        self.xindices = np.arange(0, frame_shape[0], downsample)
+        self.yindices = np.arange(0, frame_shape[1], downsample)
+
+        self.radii = np.sqrt(self.xindices[:,np.newaxis]**2 + self.yindices[np.newaxis,:]**2)
+        self.bins, self.binCounts, centres = radialBins(self.radii, self.max_pixel_len, self.pixel_bin_width)
+        self.inRadii = centres[self.binCounts > 0].astype(float)
+
+        self.frames = deque(maxlen = frame_stride + 1)
+        self.blank = True
+        self.corrLens = np.zeros(max(num_frames-frame_stride, 0))
+        self.xMeans = np.zeros(len(self.corrLens))
+        self.yMeans = np.zeros(len(self.corrLens))
+        self.quivers = []
+
+        #Frame pairs are independent, so with several workers their optical flow is computed in a thread pool
+        #(OpenCV releases the GIL); at most 2 pairs per worker are in flight so memory stays bounded
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(workers) if workers > 1 else None
+        self.pending = deque()
+
+        #Direction fields are gathered into a reused (fft_batch, 2, x, y) buffer and autocorrelated together, in
+        #double precision (single precision FFTs of whole frames are only good to about 1e-7)
+        self.fft_batch = fft_batch
+        self.fft_input = None
+        self.batch_positions = []
+
+    def normalVectors(self, velocities):
+        #Find velocity directions; vectors with a magnitude below flt_tol are set to zero
+        return normal_vectors(velocities, self.flt_tol)
+
+    def add(self, t, frame):
+        self.blank = self.blank and not np.any(frame)
+        self.frames.append(frame)
+        if len(self.frames) == self.frames.maxlen:
+            pos = t - self.frame_stride
+            if self.executor is None:
+                self.store(pos, self.process_pair(self.frames[0], frame))
+            else:
+                self.pending.append((pos, self.executor.submit(self.process_pair, self.frames[0], frame)))
+                while len(self.pending) > 2 * self.workers:
+                    self.collect()
+
+    def collect(self):
+        pos, future = self.pending.popleft()
+        self.store(pos, future.result())
+
+    #Records the results of frame pair pos, in the order the pairs were submitted
+    def store(self, pos, pair_result):
+        directions, flow = pair_result
+        self.xMeans[pos] = directions[:,:,0].mean()
+        self.yMeans[pos] = directions[:,:,1].mean()
+        if(np.isin(pos, self.positions)):
+                downU = np.flipud(flow[:,:,0])
+                downV = np.flipud(-1*flow[:,:,1])
+                #The flow's rows are frame rows (xindices), so they run along the plot's y axis
+                self.quivers.append({'pos': pos, 'x': self.yindices, 'y': self.xindices, 'u': downU, 'v': downV})
+        if self.fft_input is None:
+            self.fft_input = np.empty((self.fft_batch, 2) + directions.shape[:2])
+        self.fft_input[len(self.batch_positions)] = np.moveaxis(directions, -1, 0)
+        self.batch_positions.append(pos)
+        if len(self.batch_positions) == self.fft_batch:
+            self.flush()
+
+    def process_pair(self, first, second):
+        if self.tiler is not None:
+            flow = tiledFlow(self.backend, first, second, self.downsample, self.tiler)
+        else:
+            flow = self.backend(first, second, self.downsample)
+        return self.normalVectors(flow), flow
+
+    #Autocorrelation of the velocity directions of every buffered frame pair, with one real FFT over the whole
+    #batch (x and y components are summed in Fourier space, so a single inverse transform is needed)
+    def flush(self):
+        count = len(self.batch_positions)
+        if count == 0:
+            return
+        directions = self.fft_input[:count]
+        spectra = rfft2(directions, workers=self.workers)
+        np.multiply(spectra, np.conjugate(spectra), out=spectra)
+        convSums = irfft2(spectra[:,0] + spectra[:,1], s=directions.shape[-2:], workers=self.workers, overwrite_x=True)
+        for pos, convSum in zip(self.batch_positions, convSums):
+            means = radialMeans(convSum, self.bins, self.binCounts)
+            try:
+                self.corrLens[pos] = self.pix_size*findRoot(self.inRadii,means,self.decay_threshold)
+            except ValueError:
+                self.corrLens[pos] = 0
+        self.batch_positions = []
+
+    def result(self):
+        while self.pending:
+            self.collect()
+        self.flush()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+        # Error Checking: Empty Images
+        if self.blank:
+           verdict = "Data not available for this channel."
+           return verdict, None
+
+        corrLens = self.corrLens
+        if(len(corrLens[corrLens>self.min_corr_len])/len(corrLens) > self.min_fraction):
+            verdict = 1
+        else:
+            verdict = 0
+        plot_data = {'corrLens': corrLens, 'quivers': self.quivers}
+
+        print("x mean: ", self.xMeans.mean(), "\n")
+        print("y mean: ", self.yMeans.mean(), "\n")
+
+        return verdict, plot_data
+
+def check_flow(file, channel, min_corr_len, min_fraction, frame_stride, downsample, pix_size, bin_width, decay_threshold = 1/np.exp(1), backend = 'farneback', workers = 1, fft_batch = 1):
     if(len(file.shape) == 4):
             images = file[:,:,:,channel]
     else:
             images = file[:,:,:]
-    positions = np.array([0, int(np.floor(len(images)/2)), len(images) - frame_stride - 1])
-
-    # Error Checking: Empty Images
-    if (images == 0).all():
-       verdict = "Data not available for this channel."
-       return verdict, fig
-
-    xindices = np.arange(0, images[0].shape[0], downsample)
-    yindices = np.arange(0, images[0].shape[1], downsample)
-
-    radii = np.zeros((len(xindices),len(yindices)))
-    for i in range(0,len(xindices)):
-        for j in range(0,len(yindices)):
-            radii[i][j] = np.sqrt(xindices[i]**2 + yindices[j]**2)
-
-    #For each consecutive pair
-    corrLens = np.zeros(len(images)-frame_stride)
-    pos = 0
-    xMeans = np.array([])
-    yMeans = np.array([])
-    
-    for iter in range(0,len(images)-frame_stride,1):
-        flow = cv.calcOpticalFlowFarneback(images[iter], images[iter+frame_stride], None, 0.5, 3, 20, 3, 5, 1.2, 0)
-        directions = normalVectors(flow[xindices][:,yindices])
-        dirX = directions[:,:,0]
-        dirY = directions[:,:,1]
-        xMeans = np.append(xMeans, dirX.mean())
-        yMeans = np.append(yMeans, dirY.mean())
-        if(np.isin(pos, positions)):
-                downU = flow[:,:,0][xindices][:,yindices]
-                downU = np.flipud(downU)
-                downV = -1*flow[:,:,1][xindices][:,yindices]
-                downV = np.flipud(downV)
-                fig2, ax2 = plt.subplots(figsize=(10,10))
-                q = ax2.quiver(xindices, yindices, downU, downV,color='blue')
-                fig2.savefig(name + '_' + str(pos) + '.png')
-                plt.close(fig2)
-        xFFT = fft2(dirX)
-        xConv = np.real(ifft2(np.multiply(xFFT,np.conjugate(xFFT))))
-        yFFT = fft2(dirY)
-        yConv = np.real(ifft2(np.multiply(yFFT,np.conjugate(yFFT))))
-        convSum = np.add(xConv,yConv)
-        means = np.array([])
-        inRadii = np.array([])
-        for i in range(0,int(max_pixel_len),int(pixel_bin_width)):
-                inBin = convSum[(radii > i -.5*pixel_bin_width)&(radii < i + .5*pixel_bin_width)]
-                if(len(inBin) > 0):
-                        inRadii = np.append(inRadii, i)
-                        means = np.append(means, inBin.mean()/convSum[0,0])
-        try:
-            corrLens[pos] = pix_size*findRoot(inRadii,means,decay_threshold)
-        except ValueError:
-            corrLens[pos] = 0
-        pos += 1
-    
-    if(len(corrLens[corrLens>min_corr_len])/len(corrLens) > min_fraction):
-        verdict = 1
-    else:
-        verdict = 0
-    ax.plot(range(0,len(corrLens)),corrLens)
 
-    print("x mean: ", xMeans.mean(), "\n")
-    print("y mean: ", yMeans.mean(), "\n")
-    
-    return verdict, fig
+    accumulator = FlowAccumulator(len(images), images.shape[1:3], min_corr_len, min_fraction, frame_stride, downsample, pix_size, bin_width, decay_threshold, backend, workers, fft_batch)
+    for t in range(len(images)):
+        accumulator.add(t, images[t])
+    return accumulator.result()
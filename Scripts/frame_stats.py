@@ -0,0 +1,95 @@
+import numpy as np
+from collections import OrderedDict
+
+# Largest intensity range counted with an integer histogram before falling back to scipy.stats.mode
+max_histogram_bins = 1 << 22
+
+def intensity_histogram(frame):
+    # (lowest value, count of every integer value from it up) for integer-valued frames, None for true floats or
+    # intensity ranges too wide to count
+    values = frame.ravel()
+    if np.issubdtype(values.dtype, np.integer):
+        integer_valued = True
+    else:
+        integer_valued = bool(np.all(np.isfinite(values))) and bool(np.all(np.floor(values) == values))
+    if not integer_valued:
+        return None
+    # uint8 and uint16 values are counted as they are; other dtypes (floats, signed or wider integers, which
+    # np.bincount does not take) are counted from their lowest value as int64
+    small_unsigned = values.dtype in (np.uint8, np.uint16)
+    low, high = (0, values.max()) if small_unsigned else (values.min(), values.max())
+    if high - low >= max_histogram_bins:
+        return None
+    counts = np.bincount(values if small_unsigned else np.subtract(values, low, dtype=np.int64, casting='unsafe'), minlength=int(high - low) + 1)
+    return low, counts
+
+def frame_mean(frame, axis = None):
+    # Mean intensity in float64 whatever the frame's dtype (NumPy would average float32 frames in float32), so a
+    # movie screens the same whichever dtype it was saved or is held in
+    return np.mean(frame, axis=axis, dtype=np.float64)
+
+def mean_mode(frame, histogram):
+    # The mode (smallest most frequent value, as in scipy.stats.mode) of integer-valued frames comes from their
+    # intensity histogram, which for integer dtypes also gives the mean exactly; true floats fall back to sorting
+    # with scipy.stats.mode
+    if histogram is not None:
+        low, counts = histogram
+        mode_intensity = frame.dtype.type(low + np.argmax(counts))
+        if np.issubdtype(frame.dtype, np.integer):
+            mean_intensity = np.dot(counts, np.arange(len(counts), dtype=np.float64) + float(low)) / frame.size
+        else:
+            mean_intensity = frame_mean(frame)
+        return mean_intensity, mode_intensity
+    from scipy.stats import mode
+    return frame_mean(frame), mode(frame.ravel(), keepdims=False).mode
+
+class FrameMemo:
+    # Per-file memo of quantities derived from single frames (means, extrema, histograms, binarized frames), keyed
+    # by (channel, frame index, quantity) so each is computed once however many trackers ask for it. Entries are
+    # evicted least recently used once their arrays exceed budget_mb.
+    def __init__(self, budget_mb = 64):
+        self.budget = budget_mb * 1024 * 1024
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key, compute):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+        self.misses += 1
+        value = compute()
+        nbytes = sum(getattr(part, 'nbytes', 8) for part in (value if isinstance(value, tuple) else (value,)))
+        if nbytes <= self.budget:
+            self.entries[key] = (value, nbytes)
+            self.size += nbytes
+            while self.size > self.budget:
+                self.size -= self.entries.popitem(last=False)[1][1]
+        return value
+
+    def channel(self, channel):
+        return ChannelStats(self, channel)
+
+class ChannelStats:
+    # The quantities of one channel of a FrameMemo; the caller passes the frame at index t, which is only used on a miss
+    def __init__(self, memo, channel):
+        self.memo = memo
+        self.channel = channel
+
+    def derived(self, name, t, frame, compute):
+        # Memoizes compute(frame) under name, for tracker specific quantities such as binarized frames
+        return self.memo.lookup((self.channel, t, name), lambda: compute(frame))
+
+    def mean(self, t, frame):
+        return self.derived('mean', t, frame, frame_mean)
+
+    def extrema(self, t, frame):
+        return self.derived('extrema', t, frame, lambda frame: (np.min(frame), np.max(frame)))
+
+    def histogram(self, t, frame):
+        return self.derived('histogram', t, frame, intensity_histogram)
+
+    def mean_mode(self, t, frame):
+        return self.derived('mean_mode', t, frame, lambda frame: mean_mode(frame, self.histogram(t, frame)))
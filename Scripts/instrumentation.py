@@ -0,0 +1,81 @@
+import os, json, time, cProfile, tracemalloc
+from contextlib import contextmanager, nullcontext
+
+class StageRecorder:
+    # Adds up the wall time, CPU time (of the whole process, so including worker threads) and peak allocation of
+    # named stages per channel; a stage can be entered many times (once per frame for the trackers) and stages may
+    # be nested, in which case the enclosing stage includes the nested one. Peak allocations are traced with
+    # tracemalloc, as the largest growth over the memory allocated when the stage was entered.
+    def __init__(self, trace_memory = True):
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.totals = {}
+        self.stack = []
+
+    @contextmanager
+    def stage(self, name, channel = None):
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            for outer in self.stack:
+                outer['peak'] = max(outer['peak'], peak)
+            tracemalloc.reset_peak()
+        else:
+            current = 0
+        entered = {'start': current, 'peak': current}
+        self.stack.append(entered)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            self.stack.pop()
+            if self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                for frame in self.stack + [entered]:
+                    frame['peak'] = max(frame['peak'], peak)
+            total = self.totals.setdefault((name, channel), {'wall_s': 0.0, 'cpu_s': 0.0, 'peak_alloc_mb': 0.0 if self.trace_memory else None, 'calls': 0})
+            total['wall_s'] += wall
+            total['cpu_s'] += cpu
+            total['calls'] += 1
+            if self.trace_memory:
+                total['peak_alloc_mb'] = max(total['peak_alloc_mb'], (entered['peak'] - entered['start']) / (1024 * 1024))
+
+    def records(self, file_path):
+        # Returns the totals recorded so far as one dictionary per stage and channel, and starts over
+        records = [dict(file=file_path, stage=name, channel=channel, **total) for (name, channel), total in self.totals.items()]
+        self.totals = {}
+        return records
+
+def stage(recorder, name, channel = None):
+    # recorder.stage(name, channel), or a no-op when instrumentation is off
+    return nullcontext() if recorder is None else recorder.stage(name, channel)
+
+def open_recorder(config_data):
+    # Returns None when instrumentation is disabled
+    instrumentation_data = config_data.get('instrumentation_parameters', {})
+    if instrumentation_data.get('enabled', False) != True:
+        return None
+    return StageRecorder(instrumentation_data.get('trace_memory', True))
+
+def write_records(records, directory, append = True):
+    # Appends the records as JSON lines to instrumentation.jsonl in directory
+    with open(os.path.join(directory, 'instrumentation.jsonl'), 'a' if append else 'w') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+@contextmanager
+def profiling(file_path, config_data):
+    # Runs the enclosed code under cProfile when file_path ends with profile_file, and saves the profile (readable
+    # with pstats, snakeviz or flameprof) as <file>_profile.prof next to it
+    profile_file = config_data.get('instrumentation_parameters', {}).get('profile_file', False)
+    if not profile_file or not file_path.endswith(profile_file):
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(os.path.splitext(file_path)[0] + '_profile.prof')
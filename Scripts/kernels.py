@@ -0,0 +1,131 @@
+import types, threading
+import importlib.util
+import numpy as np
+
+# Per-pixel kernels of the trackers, compiled with numba when it is installed (unless use_numba is set to False)
+# and plain NumPy otherwise. numba is only imported, and each kernel only compiled, when first run; compiled
+# kernels are cached next to this file, so only the first run after installing or changing them pays for
+# compilation. Each kernel has a parallel version, whose loops over rows are spread over numba's threads, and a
+# serial one used from other threads (flow pairs and resilience batches run in thread pools, and numba's default
+# threading layer must not be entered from several threads at once). numba's thread pool must be started from the
+# main thread (started from another one, it hangs the interpreter at exit), so until the main thread has run a
+# kernel, other threads run them as NumPy. Compiled kernels give bit-identical results to their NumPy versions,
+# so which one runs never changes results.
+use_numba = importlib.util.find_spec('numba') is not None
+
+compiled = {}
+compile_lock = threading.Lock()
+started = False
+# range until numba is imported, when the kernels' loops over rows become numba.prange
+prange = range
+
+def compiled_kernel(loop, parallel = True):
+    # The compiled version of loop for the calling thread, or None when it is to run as NumPy; loops that are not
+    # parallel only have their serial version
+    global prange, started
+    if not use_numba:
+        return None
+    main = threading.current_thread() is threading.main_thread()
+    with compile_lock:
+        if not started:
+            if not main:
+                return None
+            import numba
+            numba.get_num_threads() # Starts the thread pool
+            prange = numba.prange
+            started = True
+        if loop not in compiled:
+            import numba
+            if parallel:
+                compiled[loop] = (numba.njit(parallel=True, cache=True)(loop), numba.njit(cache=True)(serial_copy(loop)))
+            else:
+                compiled[loop] = (numba.njit(cache=True)(loop),) * 2
+    return compiled[loop][0 if main else 1]
+
+def serial_copy(loop):
+    # A copy of loop under another name: numba's cache does not tell parallel and serial builds of the same
+    # function apart, so without it one would be loaded from the cache in place of the other
+    copy = types.FunctionType(loop.__code__, loop.__globals__, loop.__name__ + '_serial')
+    copy.__qualname__ = loop.__qualname__ + '_serial'
+    return copy
+
+def normal_vectors_loop(velocities, tolerance, out):
+    for i in prange(velocities.shape[0]):
+        for j in range(velocities.shape[1]):
+            x = velocities[i, j, 0]
+            y = velocities[i, j, 1]
+            magnitude = np.sqrt(x * x + y * y)
+            if magnitude > tolerance:
+                out[i, j, 0] = x / magnitude
+                out[i, j, 1] = y / magnitude
+            else:
+                out[i, j, 0] = 0
+                out[i, j, 1] = 0
+
+def radial_sums_loop(values, bins, sums):
+    # Serial, adding the values up in row order as np.bincount does (partial sums of rows added up afterwards
+    # would differ from it in the last bits)
+    for i in range(values.shape[0]):
+        for j in range(values.shape[1]):
+            index = bins[i, j]
+            if index >= 0:
+                sums[index] += values[i, j]
+
+def threshold_mask_loop(frame, threshold, out):
+    for i in prange(frame.shape[0]):
+        for j in range(frame.shape[1]):
+            out[i, j] = not (frame[i, j] < threshold)
+
+def bleach_correct_loop(frame, factors, lows, high, rounding, out):
+    for i in prange(frame.shape[0]):
+        for j in range(frame.shape[1]):
+            for c in range(frame.shape[2]):
+                value = factors[c] * (frame[i, j, c] - lows[c]) + lows[c]
+                if rounding:
+                    value = np.rint(value)
+                out[i, j, c] = min(value, high)
+
+def normal_vectors(velocities, tolerance):
+    # Unit vectors along the last axis (of length 2) of velocities; vectors no longer than tolerance become zero
+    kernel = compiled_kernel(normal_vectors_loop)
+    if kernel is not None:
+        out = np.empty_like(velocities)
+        kernel(velocities, tolerance, out)
+        return out
+    magnitudes = np.linalg.norm(velocities, axis=-1, keepdims=True)
+    nonzero = magnitudes > tolerance
+    return np.where(nonzero, velocities / np.where(nonzero, magnitudes, 1), 0).astype(velocities.dtype)
+
+def radial_sums(values, bins, num_bins):
+    # Sum of the values of a 2D array in each of num_bins bins, given the bin of every value in row order (-1 for none)
+    kernel = compiled_kernel(radial_sums_loop, parallel=False)
+    if kernel is not None:
+        sums = np.zeros(num_bins)
+        kernel(values, bins.reshape(values.shape), sums)
+        return sums
+    bins = bins.ravel()
+    inside = bins >= 0
+    return np.bincount(bins[inside], weights=values.ravel()[inside], minlength=num_bins)
+
+def threshold_mask(frame, threshold):
+    # Boolean mask of the pixels of a 2D frame that are not below threshold
+    kernel = compiled_kernel(threshold_mask_loop)
+    if kernel is not None:
+        out = np.empty(frame.shape, dtype=np.bool_)
+        kernel(frame, threshold, out)
+        return out
+    return np.logical_not(frame < threshold)
+
+def bleach_correct(frame, factors, lows, out):
+    # Writes factors * (frame - lows) + lows, with one factor and low per channel of a [y, x, c] frame, into out
+    # (which may be frame itself); for integer dtypes it is rounded to the nearest integer (half to even) and cut
+    # off at their largest value
+    rounding = out.dtype.kind in 'iu'
+    high = np.iinfo(out.dtype).max if rounding else np.inf
+    kernel = compiled_kernel(bleach_correct_loop)
+    if kernel is not None:
+        kernel(frame, factors, lows, high, rounding, out)
+    else:
+        corrected = factors * (frame - lows) + lows
+        out[...] = np.minimum(np.rint(corrected) if rounding else corrected, high)
+    return out
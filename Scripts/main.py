@@ -1,105 +1,220 @@
-from reader import read_file
-import os, csv, sys, yaml
-from resilience_tracker import check_resilience
-from flow_tracker import check_flow
-from coarse_tracker import check_coarse
+from reader import read_file, movie_shape, FrameSource
+import os, csv, yaml, time, argparse, traceback
+import multiprocessing as mp
+from multiprocessing.connection import wait
+from resilience_tracker import ResilienceAccumulator
+from flow_tracker import FlowAccumulator
+from coarse_tracker import CoarseAccumulator
+from plotter import submit_render, finish_rendering
+from result_cache import open_cache
+from summary_writer import open_summary
+from instrumentation import open_recorder, stage, write_records, profiling
+from tiling import open_tiler, roi_regions
+from prefetch import open_prefetcher
+from frame_stats import FrameMemo
 import numpy as np
-from pathlib import Path
-import matplotlib.pyplot as plt
-from matplotlib import gridspec
 
 
-def execute_htp(filepath, config_data):
+def execute_htp(filepath, config_data, cache = None, recorder = None, preloaded = None):
     reader_data = config_data['reader']
-    channel_select, resilience, flow, coarsening, verbose, accept_dim = reader_data.values()
+    channel_select = reader_data['channel_select']
+    resilience = reader_data['resilience']
+    flow = reader_data['flow']
+    coarsening = reader_data['coarsening']
+    verbose = reader_data['verbose']
+    accept_dim = reader_data['accept_dim_images']
+    lazy = reader_data.get('lazy_loading', False)
+    correct_bleaching = reader_data.get('bleach_correction', False)
+    render_workers = config_data.get('plot_parameters', {}).get('render_workers', 0)
     r_data = config_data['resilience_parameters']
     f_data = config_data['flow_parameters']
     c_data = config_data['coarse_parameters']
     
-    def check(channel, resilience, flow, coarse, resilience_data, flow_data, coarse_data):
-        if resilience == True:
+    enabled = [tracker for tracker, selected in (('resilience', resilience), ('flow', flow), ('coarse', coarsening)) if selected == True]
+
+    def make_accumulators(label, frame_shape, trackers, resilience_data, flow_data, coarse_data):
+        accumulators = {}
+        num_frames = shape[0]
+        height, width = frame_shape
+        if 'resilience' in trackers:
             r_offset = resilience_data['r_offset']
             pt_loss, pt_gain = resilience_data['percent_threshold'].values()
             f_step = resilience_data['frame_step']
             f_start, f_stop = resilience_data['evaluation_settings'].values()
-            r, rfig, void_value, spanning = check_resilience(file, channel, r_offset, pt_loss, pt_gain, f_step, f_start, f_stop)
+            r_workers = resilience_data.get('workers', 1)
+            r_batch = resilience_data.get('batch_size', 8)
+            span_step = resilience_data.get('span_step', False)
+            accumulators['resilience'] = ResilienceAccumulator(num_frames, (height, width), r_offset, pt_loss, pt_gain, f_step, f_start, f_stop, r_workers, r_batch, span_step, memo.channel(label), tiler)
+        if 'flow' in trackers:
+            mcorr_len = flow_data['min_corr_len']
+            min_fraction = flow_data['min_fraction']
+            frame_step = flow_data['frame_step']
+            downsample = flow_data['downsample']
+            pix_size = flow_data['pixel_size']
+            bin_width = flow_data['bin_width']
+            backend = flow_data.get('flow_backend', 'farneback')
+            workers = flow_data.get('workers', 1)
+            fft_batch = flow_data.get('fft_batch', 1)
+            accumulators['flow'] = FlowAccumulator(num_frames, (height, width), mcorr_len, min_fraction, frame_step, downsample, pix_size, bin_width, backend = backend, workers = workers, fft_batch = fft_batch, tiler = tiler)
+        if 'coarse' in trackers:
+            fframe, lframe = coarse_data['evaluation_settings'].values()
+            t_percent = coarse_data['threshold_percentage']
+            series_step = coarse_data.get('series_step', False)
+            accumulators['coarse'] = CoarseAccumulator(num_frames, fframe, lframe, t_percent, series_step, memo.channel(label))
+        return accumulators
+
+    def tracker_output(tracker, accumulator, channel):
+        # Everything check needs from a finished tracker; this is also what the result cache stores
+        with stage(recorder, tracker, channel):
+            output = {'result': accumulator.result()}
+        if tracker == 'resilience':
+            output['span_series'] = accumulator.span_series
+        if tracker == 'coarse':
+            output['coarse_series'] = accumulator.coarse_series
+        return output
+
+    def check(channel, outputs):
+        if 'resilience' in outputs:
+            r, r_plot, void_value, spanning = outputs['resilience']['result']
+            if outputs['resilience']['span_series']:
+                with stage(recorder, 'write', channel):
+                    write_span_series(outputs['resilience']['span_series'], remove_extension(filepath) + '_channel' + str(channel) + '_spanning.csv')
         else:
             r = "Resilience not tested"
-            rfig = None
+            r_plot = None
             spanning = None
             void_value = None
-        if flow == True:
-            mcorr_len, min_fraction, frame_step, downsample, pix_size, bin_width = flow_data.values()
-            f, ffig = check_flow(file, remove_extension(filepath)+'_channel'+str(channel), channel, mcorr_len, min_fraction, frame_step, downsample, pix_size, bin_width)
+        if 'flow' in outputs:
+            f, f_plot = outputs['flow']['result']
         else:
             f = "Flow not tested"
-            ffig = None
-        if coarse == True:
-            fframe, lframe = coarse_data['evaluation_settings'].values()
-            t_percent = coarse_data['threshold_percentage']
-            c, cfig, c_areas = check_coarse(file, channel, fframe, lframe, t_percent)
+            f_plot = None
+        if 'coarse' in outputs:
+            c, c_plot, c_areas = outputs['coarse']['result']
+            if outputs['coarse'].get('coarse_series'):
+                with stage(recorder, 'write', channel):
+                    write_coarse_series(outputs['coarse']['coarse_series'], remove_extension(filepath) + '_channel' + str(channel) + '_coarsening.csv')
         else:
             c = "Coarseness not tested."
-            cfig = None
+            c_plot = None
             c_areas = None
 
-        figpath = remove_extension(filepath) + '_channel' + str(channel) + '_graphs.png'
+        quiver_prefix = remove_extension(filepath) + '_channel' + str(channel)
+        figpath = quiver_prefix + '_graphs.png'
         if verbose == True:
-            fig = plt.figure(figsize = (15, 5))
-            gs = gridspec.GridSpec(1,3)
-
-            if rfig != None:
-                ax1 = rfig.axes[0]
-                ax1.remove()
-                ax1.figure = fig
-                fig.add_axes(ax1)
-                ax1.set_position([2.5/15, 1/10, 4/5, 4/5])
-
-            if ffig != None:
-
-                ax2 = ffig.axes[0]
-                ax2.remove()
-                ax2.figure = fig
-                fig.add_axes(ax2)
-                ax2.set_position([17.5/15, 1/10, 4/5, 4/5])
-
-            if cfig != None:               
-                ax3 = cfig.axes[0]
-                ax3.remove()
-                ax3.figure = fig
-                fig.add_axes(ax3)
-                ax3.set_position([32.5/15, 1/10, 4/5, 4/5])
-
-            plt.savefig(figpath)
-        plt.close(rfig)
-        plt.close(ffig)
-        plt.close(cfig)
+            with stage(recorder, 'plot', channel):
+                submit_render(figpath, quiver_prefix, r_plot, f_plot, c_plot, render_workers)
             
         return [channel, r, f, c, void_value, spanning, c_areas]
     
-    file = read_file(filepath, accept_dim)
+    def read_movie():
+        with stage(recorder, 'read'):
+            return read_file(filepath, accept_dim, lazy, memo, recorder, correct_bleaching)
 
-    if (isinstance(file, np.ndarray) == False):
-        return None
+    shape = None
+    if preloaded is not None: # Already read by the prefetcher
+        file, memo = preloaded
+    else:
+        # Per-frame quantities shared between the dimness check and the trackers of every channel
+        memo = FrameMemo(reader_data.get('memo_budget_mb', 64))
+        # With a result cache, outputs are looked up from the movie's shape in its metadata, and the movie is only
+        # read once some of them turn out to be missing
+        shape = movie_shape(filepath) if cache is not None else None
+        file = read_movie() if shape is None else None
+
+    if shape is None:
+        if (isinstance(file, (np.ndarray, FrameSource)) == False):
+            return None
+        shape = file.shape
+
+    planes, cache_keys = screen_plan(filepath, config_data, shape, cache)
+    if channel_select == -1:
+        print('Total Channels:', min(shape))
+
+    tiler = open_tiler(config_data)
+
+    # Reuse cached outputs of trackers whose file, channel, region and parameters are unchanged
+    outputs = {label: {} for label in planes}
+    for (label, tracker), key in cache_keys.items():
+        cached = cache.get(key)
+        if cached is not None:
+            outputs[label][tracker] = cached
+
+    accumulators = {}
+    for label, (rows, columns, channel) in planes.items():
+        frame_shape = (len(range(shape[1])[rows]), len(range(shape[2])[columns]))
+        accumulators[label] = make_accumulators(label, frame_shape, [tracker for tracker in enabled if tracker not in outputs[label]], r_data, f_data, c_data)
+    if any(accumulators.values()):
+        if file is None:
+            file = read_movie()
+            if (isinstance(file, (np.ndarray, FrameSource)) == False):
+                return None
+        stream_frames(file, accumulators, recorder, planes)
+
+    for label in planes:
+        for tracker, accumulator in accumulators[label].items():
+            outputs[label][tracker] = tracker_output(tracker, accumulator, label)
+            if cache is not None:
+                cache.put(cache_keys[label, tracker], outputs[label][tracker])
+    if cache is not None:
+        cache.evict()
+    if tiler is not None:
+        tiler.close()
 
-    channels = min(file.shape)
+    rfc = []
+    for label in planes:
+        print('Channel:', label)
+        rfc.append(check(label, outputs[label]))
+
+    return rfc
+
+def screen_plan(filepath, config_data, shape, cache = None):
+    # What execute_htp screens in a movie of [t, y, x, c] shape, worked out without reading it: the planes
+    # (every channel is analysed as a whole, or once per region of interest; each is labelled by its channel number,
+    # followed by _roi<n> for regions of interest, and maps to the [y, x, c] index of its pixels in a frame) and,
+    # with a cache, the key of every (label, tracker) output
+    reader_data = config_data['reader']
+    channel_select = reader_data['channel_select']
+    channels = min(shape)
     
     if (isinstance(channel_select, int) == False) or channel_select > channels:
         raise ValueError("Please give correct channel input (-1 for all channels, 0 for channel 1, etc)")
-    
-    rfc = []
-    
-    if channel_select == -1:
-        print('Total Channels:', channels)
-        for channel in range(channels):
-            print('Channel:', channel)
-            rfc.append(check(channel, resilience, flow, coarsening, r_data, f_data, c_data))
-    
-    else:
-        print('Channel: ', channel_select)
-        rfc.append(check(channel_select, resilience, flow, coarsening, r_data, f_data, c_data))
+    channel_list = range(channels) if channel_select == -1 else [channel_select]
 
-    return rfc
+    planes = {}
+    for channel in channel_list:
+        for suffix, (rows, columns) in roi_regions(config_data, shape[1:3]):
+            planes[str(channel) + suffix if suffix else channel] = (rows, columns, channel)
+
+    cache_keys = {}
+    if cache is not None:
+        tracker_data = {'resilience': config_data['resilience_parameters'], 'flow': config_data['flow_parameters'], 'coarse': config_data['coarse_parameters']}
+        tiling_data = config_data.get('tiling_parameters', {})
+        enabled = [tracker for tracker, selected in (('resilience', reader_data['resilience']), ('flow', reader_data['flow']), ('coarse', reader_data['coarsening'])) if selected == True]
+        for label, (rows, columns, channel) in planes.items():
+            for tracker in enabled:
+                parameters = dict(tracker_data[tracker])
+                if rows != slice(None):
+                    parameters['roi'] = [rows.start, columns.start, rows.stop, columns.stop]
+                if tracker == 'flow' and tiling_data.get('tile_size', False): # Tiling only changes the flow results
+                    parameters['tiling'] = [tiling_data['tile_size'], tiling_data.get('overlap', 0)]
+                if reader_data.get('bleach_correction', False):
+                    parameters['bleach_correction'] = True
+                cache_keys[label, tracker] = cache.key(filepath, label, tracker, parameters)
+    return planes, cache_keys
+
+def stream_frames(file, accumulators, recorder = None, planes = None):
+    # Reads every frame of the movie exactly once and pushes each channel's plane (or the [y, x, c] index in
+    # planes, for regions of interest) through that channel's tracker accumulators, so only the few frames the
+    # accumulators hold on to are ever in memory
+    for t in range(len(file)):
+        with stage(recorder, 'read'):
+            frame = file[t]
+        for label, label_accumulators in accumulators.items():
+            plane = frame[planes[label]] if planes is not None else frame[:, :, label]
+            for tracker, accumulator in label_accumulators.items():
+                with stage(recorder, tracker, label):
+                    accumulator.add(t, plane)
 
 def remove_extension(filepath):
     if filepath.endswith('.tiff'):
@@ -109,71 +224,294 @@ def remove_extension(filepath):
     if filepath.endswith('.nd2'):
         return filepath.removesuffix('.nd2')
 
-def writer(data, directory):
-    if data:
-        headers = ['Channel', 'Resilience', 'Flow', 'Coarseness', 'Largest void', 'Span', 'Intensity Difference Area']
-        output_filepath = os.path.join(directory, "summary.csv")
-        with open(output_filepath, 'w', newline='') as csvfile:
-            csvwriter = csv.writer(csvfile)
-            for entry in data:
-                if isinstance(entry, list) and len(entry) == 1:
-                    # Write the file name
-                    csvwriter.writerow(entry)
-                    csvwriter.writerow(headers)  # Write headers after the filename
-                elif entry:
-                    # Write the headers if entry contains channel data
-                    csvwriter.writerow(headers)
-                    headers = []  # Ensure headers are only written once per file
-                    csvwriter.writerow(entry)
+def write_span_series(span_series, output_filepath):
+    with open(output_filepath, 'w', newline='') as csvfile:
+        csvwriter = csv.writer(csvfile)
+        csvwriter.writerow(['Frame', 'Spans top to bottom', 'Spans left to right'])
+        csvwriter.writerows(span_series)
+
+def write_coarse_series(coarse_series, output_filepath):
+    with open(output_filepath, 'w', newline='') as csvfile:
+        csvwriter = csv.writer(csvfile)
+        csvwriter.writerow(['Frame', 'Mean', 'Mode', 'Mean-mode gap', 'Gap increase (%)', 'Coarsening', 'Peak area', 'Peak to trough area'])
+        csvwriter.writerows(coarse_series)
+
+def find_files(root_dir):
+    file_paths = []
+    for dirpath, dirnames, filenames in os.walk(root_dir):
+
+        dirnames[:] = sorted(d for d in dirnames if d != "Resilience analysis" and d != "contraction_analysis" and d != ".htp_cache" and d != "summary.parquet")
+
+        for filename in sorted(filenames):
+            if filename.startswith('._'):
+                continue
+            file_paths.append(os.path.join(dirpath, filename))
+    return file_paths
+
+def screen_file(file_path, config_data, cache = None, recorder = None, preloaded = None):
+    # execute_htp, run under cProfile when file_path is the file chosen for profiling
+    with profiling(file_path, config_data), stage(recorder, 'total'):
+        return execute_htp(file_path, config_data, cache, recorder, preloaded)
+
+def load_file(file_path, config_data, cache = None):
+    # What the prefetcher does ahead of a file's analysis. Lazily read movies only have their bytes read once, so
+    # that execute_htp later finds them in the OS page cache; otherwise the movie is read and decoded into memory
+    # (with the dimness check) and handed to execute_htp as (file, memo).
+    reader_data = config_data['reader']
+    if not file_path.endswith(('.tiff', '.tif', '.nd2')):
+        return None
+    if cache is not None:
+        shape = movie_shape(file_path)
+        if shape is not None and all(os.path.isfile(cache.path(key)) for key in screen_plan(file_path, config_data, shape, cache)[1].values()):
+            return None # Every output is cached, so the movie is not needed
+    if reader_data.get('lazy_loading', False):
+        with open(file_path, 'rb') as f:
+            while f.read(1 << 24):
+                pass
+        return None
+    memo = FrameMemo(reader_data.get('memo_budget_mb', 64))
+    return read_file(file_path, reader_data['accept_dim_images'], False, memo, None, reader_data.get('bleach_correction', False)), memo
+
+def screen_worker(file_path, config_data, cache, conn):
+    # Runs in a child process; the result, cache statistics and stage timings (or the traceback) are sent back
+    # through the pipe
+    try:
+        if cache is not None:
+            cache.stats = dict.fromkeys(cache.stats, 0) # Only this file's lookups are reported back to the parent
+        recorder = open_recorder(config_data)
+        rfc_data = screen_file(file_path, config_data, cache, recorder)
+        with stage(recorder, 'plot'):
+            finish_rendering()
+        records = recorder.records(file_path) if recorder is not None else []
+        conn.send(('ok', (rfc_data, cache.stats if cache is not None else None, records)))
+    except Exception:
+        conn.send(('error', traceback.format_exc()))
+    finally:
+        conn.close()
+
+def screen_serially(file_paths, config_data, cache = None, recorder = None):
+    # Stage timings stay in the caller's recorder, so no records are yielded. With prefetching, the next files
+    # are read in the background while one is analysed; waiting for them is recorded as the io_wait stage.
+    prefetcher = open_prefetcher(file_paths, lambda file_path: load_file(file_path, config_data, cache), config_data)
+    try:
+        for index, file_path in enumerate(file_paths):
+            print(file_path)
+            preloaded = None
+            if prefetcher is not None:
+                with stage(recorder, 'io_wait'):
+                    preloaded = prefetcher.take(index)
+            yield file_path, screen_file(file_path, config_data, cache, recorder, preloaded), []
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+            print(prefetcher.report())
+
+def screen_files(file_paths, config_data, workers = 1, timeout = None, cache = None):
+    # Fans files out to at most `workers` child processes (one per file), so that a crashing or
+    # hanging file only loses its own result. Yields (file_path, result, stage records) in the order of file_paths
+    # as soon as a file and every file before it have finished (result is None for failed files).
+    results = {}
+    next_index = 0
+    pending = list(range(len(file_paths)))[::-1]
+    running = {}
+
+    try:
+        while pending or running:
+            while pending and len(running) < workers:
+                index = pending.pop()
+                recv_conn, send_conn = mp.Pipe(duplex=False)
+                process = mp.Process(target=screen_worker, args=(file_paths[index], config_data, cache, send_conn))
+                process.start()
+                send_conn.close()
+                running[index] = (process, recv_conn, time.monotonic())
+
+            ready = wait([conn for _, conn, _ in running.values()], timeout=1)
+
+            for index, (process, conn, started) in list(running.items()):
+                file_path = file_paths[index]
+                if conn in ready:
+                    try:
+                        status, payload = conn.recv()
+                    except EOFError:
+                        process.join()
+                        status, payload = 'error', 'worker exited with code ' + str(process.exitcode)
+                    if status == 'ok':
+                        rfc_data, stats, records = payload
+                        results[index] = (rfc_data, records)
+                        if cache is not None:
+                            cache.merge_stats(stats)
+                    else:
+                        results[index] = (None, [])
+                        print(file_path + ' failed, skipping to next file...\n' + payload)
+                elif timeout and time.monotonic() - started > timeout:
+                    process.terminate()
+                    results[index] = (None, [])
+                    print(file_path + ' timed out after ' + str(timeout) + ' s, skipping to next file...')
                 else:
-                    # Write an empty row
-                    csvwriter.writerow([])
+                    continue
+                process.join()
+                conn.close()
+                del running[index]
 
-def process_directory(root_dir, config_data):
-    
+            while next_index in results:
+                yield (file_paths[next_index],) + results.pop(next_index)
+                next_index += 1
+    finally:
+        for process, conn, _ in running.values():
+            process.terminate()
+            process.join()
+            conn.close()
+
+def process_directory(root_dir, config_data, resume = None):
+    # Each file's rows are written to the summary as soon as the file is screened; with resume, files already
+    # in the summary of an earlier run are skipped. Stage timings, when enabled, go to instrumentation.jsonl next to
+    # the summary.
     if os.path.isfile(root_dir):
-        all_data = []
         file_path = root_dir
         filename = os.path.basename(file_path)
         dir_name = os.path.dirname(file_path)
-        rfc_data = execute_htp(file_path, config_data)
+        summary = open_summary(config_data, dir_name, resume)
+        if summary.is_done(filename):
+            print(filename + ' is already in the summary, skipping...')
+            return
+        cache = open_cache(config_data, dir_name)
+        recorder = open_recorder(config_data)
+        rfc_data = screen_file(file_path, config_data, cache, recorder)
         if rfc_data == None:
             raise TypeError("Please input valid file type ('.nd2', '.tiff', '.tif')")
-        all_data.append([filename])
-        all_data.extend(rfc_data)
-        all_data.append([])
-
-        writer(all_data, dir_name)
+        with stage(recorder, 'write'):
+            summary.add(filename, rfc_data)
+        summary.close()
+        with stage(recorder, 'plot'):
+            finish_rendering()
+        if recorder is not None:
+            write_records(recorder.records(file_path), dir_name, summary.resume)
+        if cache is not None:
+            print(cache.report())
     else: 
-        all_data = []
-        for dirpath, dirnames, filenames in os.walk(root_dir):
-    
-            dirnames[:] = [d for d in dirnames if d != "Resilience analysis" and d != "contraction_analysis"]
-    
-            for filename in filenames:
-                if filename.startswith('._'):
-                    continue
-                file_path = os.path.join(dirpath, filename)
-                print(file_path)
-                rfc_data = execute_htp(file_path, config_data)
-                if rfc_data == None:
-                    continue
-                all_data.append([file_path])
-                all_data.extend(rfc_data)
-                all_data.append([])
+        summary = open_summary(config_data, root_dir, resume)
+        file_paths = find_files(root_dir)
+        skipped = [file_path for file_path in file_paths if summary.is_done(file_path)]
+        if skipped:
+            print('Resuming: skipping', len(skipped), 'files already in the summary')
+            file_paths = [file_path for file_path in file_paths if not summary.is_done(file_path)]
+        cache = open_cache(config_data, root_dir)
+        recorder = open_recorder(config_data)
+        if recorder is not None and not summary.resume:
+            write_records([], root_dir, append = False) # Starts a new instrumentation.jsonl
 
-        writer(all_data, root_dir)
+        try:
+            screen_into_summary(file_paths, config_data, summary, root_dir, cache, recorder)
+        finally:
+            summary.close()
+        finish_rendering()
+        if cache is not None:
+            print(cache.report())
 
-def main():
-    dir_name = sys.argv[1]
-    if len(sys.argv) == 3:
-        config_path = sys.argv[2]
+def screen_into_summary(file_paths, config_data, summary, root_dir, cache = None, recorder = None):
+    # Screens the files (in worker processes when parallel_parameters ask for it) and adds each one's rows to the
+    # summary as it finishes; returns the files that failed
+    parallel_data = config_data.get('parallel_parameters', {})
+    workers = parallel_data.get('workers', 1)
+    timeout = parallel_data.get('file_timeout', False)
+    if workers > 1 or timeout:
+        print('Screening', len(file_paths), 'files with', workers, 'workers')
+        results = screen_files(file_paths, config_data, workers, timeout, cache)
     else:
-        # Update this with your filepath -- if your directory is htp-screening-main, use that as the highest level directory instead
-        config_path = 'htp-screening/Scripts/config.yaml'
-    with open(config_path, "r") as yamlfile:
+        results = screen_serially(file_paths, config_data, cache, recorder)
+
+    failed = []
+    for file_path, rfc_data, records in results:
+        if rfc_data != None:
+            with stage(recorder, 'write'):
+                summary.add(file_path, rfc_data)
+        else:
+            failed.append(file_path)
+        if recorder is not None:
+            records += recorder.records(file_path)
+            if file_path.endswith(('.tiff', '.tif', '.nd2')): # Other files in the directory are only looked at
+                write_records(records, root_dir)
+    return failed
+
+def settled_files(root_dir, settle_s):
+    # Movies under root_dir that have not been modified for settle_s seconds, so are no longer being written
+    now = time.time()
+    settled = []
+    for file_path in find_files(root_dir):
+        if not file_path.endswith(('.tiff', '.tif', '.nd2')):
+            continue
+        try:
+            if now - os.path.getmtime(file_path) >= settle_s:
+                settled.append(file_path)
+        except OSError: # Moved or deleted since it was listed
+            pass
+    return settled
+
+def watch_directory(root_dir, config_data):
+    # Screens the movies already in root_dir and then every movie that lands in it, until interrupted. Running as
+    # one long-lived process keeps imports, compiled kernels and the result cache warm between files. Files are
+    # picked up once they have settled, and the summary is always resumed, so a restarted watcher carries on where
+    # the last one stopped; files that fail are not retried until the watcher is restarted. When screening in this
+    # process, files are screened one at a time so that an error in one does not stop the watcher.
+    watch_data = config_data.get('watch_parameters', {})
+    poll_s = watch_data.get('poll_s', 5)
+    settle_s = watch_data.get('settle_s', 30)
+    parallel_data = config_data.get('parallel_parameters', {})
+    serial = parallel_data.get('workers', 1) <= 1 and not parallel_data.get('file_timeout', False)
+    summary = open_summary(config_data, root_dir, True)
+    cache = open_cache(config_data, root_dir)
+    recorder = open_recorder(config_data)
+    failed = set()
+    print('Watching', root_dir, 'for new files (Ctrl+C to stop)')
+    try:
+        while True:
+            file_paths = [file_path for file_path in settled_files(root_dir, settle_s) if not summary.is_done(file_path) and file_path not in failed]
+            if not file_paths:
+                time.sleep(poll_s)
+                continue
+            for batch in ([[file_path] for file_path in file_paths] if serial else [file_paths]):
+                try:
+                    failed.update(screen_into_summary(batch, config_data, summary, root_dir, cache, recorder))
+                except Exception:
+                    print(batch[0] + ' failed, skipping to next file...\n' + traceback.format_exc())
+                    failed.update(batch)
+            finish_rendering()
+            if cache is not None:
+                print(cache.report())
+    except KeyboardInterrupt:
+        print('Stopped watching', root_dir)
+    finally:
+        summary.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='High-throughput screening of confocal movies')
+    parser.add_argument('dir_name', help='File or directory to screen')
+    # Update this with your filepath -- if your directory is htp-screening-main, use that as the highest level directory instead
+    parser.add_argument('config_path', nargs='?', default='htp-screening/Scripts/config.yaml')
+    parser.add_argument('--workers', type=int, help='Number of files screened in parallel (overrides config.yaml)')
+    parser.add_argument('--timeout', type=float, help='Seconds after which a single file is abandoned (overrides config.yaml)')
+    parser.add_argument('--resume', action='store_true', default=None, help='Skip files already in the summary of an interrupted run (overrides config.yaml)')
+    parser.add_argument('--instrument', action='store_true', help='Record the time and memory of every stage to instrumentation.jsonl')
+    parser.add_argument('--profile', help='Save a cProfile profile of the file whose name ends with this')
+    parser.add_argument('--watch', action='store_true', help='Keep running and screen new files as they land in the directory')
+    args = parser.parse_args()
+
+    with open(args.config_path, "r") as yamlfile:
         config_data = yaml.load(yamlfile, Loader=yaml.CLoader)
-        process_directory(dir_name, config_data)
+        parallel_data = config_data.setdefault('parallel_parameters', {})
+        if args.workers != None:
+            parallel_data['workers'] = args.workers
+        if args.timeout != None:
+            parallel_data['file_timeout'] = args.timeout
+        instrumentation_data = config_data.setdefault('instrumentation_parameters', {})
+        if args.instrument:
+            instrumentation_data['enabled'] = True
+        if args.profile != None:
+            instrumentation_data['profile_file'] = args.profile
+        if args.watch:
+            watch_directory(args.dir_name, config_data)
+        else:
+            process_directory(args.dir_name, config_data, args.resume)
 
 if __name__ == "__main__":
     main()
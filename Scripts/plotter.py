@@ -0,0 +1,81 @@
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+# Figures are built from the plain plot data returned by the trackers with the object-oriented matplotlib API
+# (no pyplot state), so rendering can happen after the analysis and in other processes; matplotlib is only
+# imported once a figure is rendered
+
+def plot_resilience(ax, data):
+    ax.plot(data['frames'], data['void_ratio'])
+    ax.set_xlabel("Frames")
+    ax.set_ylabel("Proportion of orginal void size")
+
+def plot_flow(ax, data):
+    ax.plot(range(0,len(data['corrLens'])),data['corrLens'])
+
+def plot_coarse(ax, data):
+    plt_bins = data['bins']
+    ax.plot(plt_bins, data['first_counts'], '^-', ms=4, c='darkred', alpha=0.2, label= "frame " + str(data['first_frame']+1)+" dist")
+    ax.plot(plt_bins, data['last_counts'], 'v-', ms=4, c='darkorange',   alpha=0.2, label= "frame " + str(data['last_frame']+1)+" dist")
+    ax.plot(plt_bins, data['difference'], 'D-', ms=2, c='red', label = "difference btwn")
+    ax.axvline(x = data['cutoff'])
+    ax.plot(plt_bins, data['initial_fit'], c='magenta', label='initial_fit')
+    ax.plot(data['cumulative'], c = 'darkgreen', label = 'CDF')
+    ax.axhline(0, color='dimgray', alpha=0.6)
+    ax.set_xlabel("Pixel intensity value")
+    ax.set_ylabel("Probability")
+    ax.set_xlim(0,data['max_intensity'] + 5)
+    ax.legend()
+
+def save_quivers(quivers, quiver_prefix):
+    from matplotlib.figure import Figure
+    for quiver in quivers:
+        fig = Figure(figsize=(10,10))
+        ax = fig.add_subplot()
+        ax.quiver(quiver['x'], quiver['y'], quiver['u'], quiver['v'], color='blue')
+        fig.savefig(quiver_prefix + '_' + str(quiver['pos']) + '.png')
+
+# Saves the resilience, flow and coarsening panels of one channel side by side, plus the flow quiver snapshots as
+# <quiver_prefix>_<frame>.png; a panel is left empty when its analysis was not run or had no data
+def render_channel(figpath, quiver_prefix, resilience_plot, flow_plot, coarse_plot):
+    from matplotlib.figure import Figure
+    fig = Figure(figsize = (15, 5))
+    gs = fig.add_gridspec(1,3)
+    for column, (plot, plot_function) in enumerate(((resilience_plot, plot_resilience), (flow_plot, plot_flow), (coarse_plot, plot_coarse))):
+        if plot is not None:
+            plot_function(fig.add_subplot(gs[0, column]), plot)
+    fig.savefig(figpath)
+    if flow_plot is not None:
+        save_quivers(flow_plot['quivers'], quiver_prefix)
+
+render_pool = None
+render_jobs = []
+
+# Renders in this process when workers is 0, otherwise queues the job on a background process pool. Its processes
+# are spawned rather than forked: by the time the first figure is queued, the trackers may have started numba's
+# thread pool, and forking after that leaves the interpreter hanging at exit. Either way, errors in rendering are
+# reported, not raised, so they never fail the file.
+def submit_render(figpath, quiver_prefix, resilience_plot, flow_plot, coarse_plot, workers = 0):
+    global render_pool
+    if workers == 0:
+        try:
+            render_channel(figpath, quiver_prefix, resilience_plot, flow_plot, coarse_plot)
+        except Exception as error:
+            print('Rendering failed:', error)
+        return
+    if render_pool is None:
+        render_pool = ProcessPoolExecutor(workers, mp_context=mp.get_context('spawn'))
+    render_jobs.append(render_pool.submit(render_channel, figpath, quiver_prefix, resilience_plot, flow_plot, coarse_plot))
+
+# Waits for every queued figure and shuts the pool down; errors in a render job are reported, not raised
+def finish_rendering():
+    global render_pool
+    for job in render_jobs:
+        try:
+            job.result()
+        except Exception as error:
+            print('Rendering failed:', error)
+    render_jobs.clear()
+    if render_pool is not None:
+        render_pool.shutdown()
+        render_pool = None
@@ -0,0 +1,66 @@
+import os, time
+from concurrent.futures import ThreadPoolExecutor
+
+class Prefetcher:
+    # Runs load(file_path) for the files after the one being analysed in background threads, so reading and
+    # decoding overlap with the analysis. At most `ahead` files are loaded but not yet taken, and no further load
+    # starts while those would exceed budget_mb (estimated from their size on disk); the next file needed is always
+    # loaded. Files must be taken in order; the time spent waiting for loads is kept in stats.
+    def __init__(self, file_paths, load, ahead = 1, budget_mb = 2048, workers = 1):
+        self.file_paths = list(file_paths)
+        self.load = load
+        self.ahead = ahead
+        self.budget = budget_mb * 1024 * 1024
+        self.executor = ThreadPoolExecutor(workers)
+        self.pending = {}
+        self.submitted = 0
+        self.stats = {'files': 0, 'wait_s': 0.0, 'load_s': 0.0, 'bytes': 0}
+
+    def size(self, index):
+        try:
+            return os.path.getsize(self.file_paths[index])
+        except OSError:
+            return 0
+
+    def timed_load(self, file_path):
+        start = time.perf_counter()
+        loaded = self.load(file_path)
+        return loaded, time.perf_counter() - start
+
+    def schedule(self, first):
+        # Starts loading file `first` if it is not yet, then the following files that the limits allow
+        while self.submitted < min(len(self.file_paths), first + self.ahead):
+            size = self.size(self.submitted)
+            if self.submitted > first and sum(size for _, size in self.pending.values()) + size > self.budget:
+                break
+            self.pending[self.submitted] = (self.executor.submit(self.timed_load, self.file_paths[self.submitted]), size)
+            self.submitted += 1
+
+    def take(self, index):
+        # Waits for file `index` to be loaded, starts loading the files after it and returns what load returned
+        # (errors raised by load are raised here)
+        self.schedule(index)
+        future, size = self.pending.pop(index)
+        start = time.perf_counter()
+        try:
+            loaded, load_time = future.result()
+        finally:
+            self.stats['wait_s'] += time.perf_counter() - start
+            self.schedule(index + 1)
+        self.stats['files'] += 1
+        self.stats['load_s'] += load_time
+        self.stats['bytes'] += size
+        return loaded
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+    def report(self):
+        return 'Prefetch: {files} files ({mb:.0f} MB) loaded in {load_s:.1f} s, {wait_s:.1f} s spent waiting for them'.format(mb=self.stats['bytes'] / (1024 * 1024), **self.stats)
+
+def open_prefetcher(file_paths, load, config_data):
+    # Returns None when prefetching is disabled
+    prefetch_data = config_data.get('prefetch_parameters', {})
+    if not prefetch_data.get('files', 0):
+        return None
+    return Prefetcher(file_paths, load, prefetch_data['files'], prefetch_data.get('budget_mb', 2048), prefetch_data.get('workers', 1))
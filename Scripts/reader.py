@@ -1,34 +1,170 @@
-import os, pims
-import imageio.v3 as iio
+import os, time
 import numpy as np
-from nd2reader import ND2Reader
+from collections import OrderedDict
+from instrumentation import stage
+from kernels import bleach_correct
+from frame_stats import frame_mean
 
-def read_file(file_path, accept_dim = False):
+class FrameSource:
+    # Lazy [t, y, x, c] movie: frames are pulled through read_frame(t) on demand, in their native dtype,
+    # and only the most recently touched frames are kept in memory
+    def __init__(self, read_frame, shape, dtype, cache_frames = 8):
+        self.read_frame = read_frame
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.ndim = len(self.shape)
+        self.cache_frames = cache_frames
+        self.cache = OrderedDict()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def frame(self, t):
+        t = range(self.shape[0])[t]
+        if t in self.cache:
+            self.cache.move_to_end(t)
+            return self.cache[t]
+        frame = self.read_frame(t)
+        self.cache[t] = frame
+        if len(self.cache) > self.cache_frames:
+            self.cache.popitem(last=False)
+        return frame
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        t_key, rest = key[0], key[1:]
+        if isinstance(t_key, (int, np.integer)):
+            return self.frame(t_key)[rest]
+        # file[:,:,:,channel] stays lazy, anything else is read into memory
+        if isinstance(t_key, slice) and t_key == slice(None) and len(rest) == 3 and rest[:2] == (slice(None), slice(None)) and isinstance(rest[2], (int, np.integer)):
+            return ChannelView(self, rest[2])
+        return np.stack([self.frame(t)[rest] for t in np.arange(self.shape[0])[t_key]])
+
+    def __array__(self, dtype = None, copy = None):
+        return np.asarray(self[:, :, :, :], dtype)
+
+class ChannelView:
+    # Lazy [t, y, x] view of a single channel of a FrameSource
+    def __init__(self, source, channel):
+        self.source = source
+        self.channel = channel
+        self.shape = source.shape[:3]
+        self.dtype = source.dtype
+        self.ndim = 3
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        if len(key) == 0:
+            return np.asarray(self)
+        frames = self.source[(key[0], slice(None), slice(None), self.channel)]
+        return frames[key[1:]] if len(key) > 1 else frames
+
+    def __array__(self, dtype = None, copy = None):
+        return np.asarray(self.source[:, :, :, self.channel], dtype)
+
+def read_nd2_timepoint(file, t, out = None):
+    # Reads timepoint t of an ND2 file as a [y, x, c] uint16 array. All channels of a timepoint are stored
+    # interleaved in one image chunk, so the chunk is read and decoded once instead of once per channel.
+    num_channels = len(file.metadata['channels'])
+    height = file.metadata['height']
+    width = file.metadata['width']
+    if out is None:
+        out = np.empty((height, width, num_channels), dtype=np.uint16)
+    from nd2reader.common import read_chunk
+    try:
+        parser = file.parser
+        image_group_number = parser._calculate_image_group_number(t, 0, 0)
+        data = read_chunk(parser._fh, parser._label_map.get_image_data_location(image_group_number))
+    except AttributeError: # Fall back to the public, one plane at a time interface
+        for i in range(num_channels):
+            out[:, :, i] = file.get_frame_2D(c=i, t=t)
+        return out
+    # Skip the 8 byte timestamp; stitched files may pad every row with extra values, which are cut off
+    values = np.frombuffer(data, dtype=np.uint16, offset=8)
+    true_channels = len(values) // (height * width)
+    row_length = len(values) // height
+    pixels = values[:height * row_length].reshape(height, row_length)[:, :width * true_channels]
+    out[...] = pixels.reshape(height, width, true_channels)[:, :, :num_channels]
+    return out
+
+def compact_storage(images):
+    # Dtype policy for movies held in memory: intensities are stored as uint16 (ND2 files already are), so integer
+    # or integer-valued float movies within 0-65535 saved with a wider dtype are converted, which leaves every
+    # tracker result unchanged; true floating point data keeps its dtype. Masks are bool and the flow trackers
+    # compute in float32 from there.
+    if images.dtype in (np.uint8, np.uint16) or images.dtype.kind not in 'iuf' or images.size == 0:
+        return images
+    for frame in images: # Checked a frame at a time to keep temporaries small
+        if frame.min() < 0 or frame.max() > 65535:
+            return images
+        if images.dtype.kind == 'f' and not (np.all(np.isfinite(frame)) and np.array_equal(np.floor(frame), frame)):
+            return images
+    return images.astype(np.uint16)
+
+def movie_shape(file_path):
+    # [t, y, x, c] shape of the movie read_file would return, from the file's metadata alone (nothing is decoded), or
+    # None when it cannot be told that way
+    try:
+        if file_path.endswith('.tiff') or file_path.endswith('.tif'):
+            import tifffile
+            with tifffile.TiffFile(file_path) as file:
+                shape = file.series[0].shape
+            return shape + (1,) if len(shape) == 3 else shape if len(shape) == 4 else None
+        if file_path.endswith('.nd2'):
+            from nd2reader import ND2Reader
+            with ND2Reader(file_path) as file:
+                shape = (file.sizes['t'], file.metadata['height'], file.metadata['width'], len(file.metadata['channels']))
+            return shape if shape[0] > 1 else None
+    except Exception:
+        return None
+    return None
+
+def read_file(file_path, accept_dim = False, lazy = False, memo = None, recorder = None, correct_bleaching = False):
     acceptable_formats = ('.tiff', '.tif', '.nd2')
     if (os.path.exists(file_path) and file_path.endswith(acceptable_formats)) == False:
         return None
 
     def check_first_frame_dim(file):
-        min_intensity = np.min(file[0])
-        mean_intensity = np.mean(file[0])
+        if memo is None:
+            min_intensity = np.min(file[0])
+            mean_intensity = frame_mean(file[0])
+        else: # Per-channel statistics of the first frame, which the trackers reuse (every channel has the same pixel count)
+            frame = file[0]
+            channel_stats = [(memo.channel(c), frame[:, :, c]) for c in range(frame.shape[2])]
+            min_intensity = min(stats.extrema(0, plane)[0] for stats, plane in channel_stats)
+            mean_intensity = np.mean([stats.mean(0, plane) for stats, plane in channel_stats])
         return 0.5 * mean_intensity <= min_intensity
 
-    def bleach_correction(im):
-        min_px_intensity = np.min(im)
-        num_frames=len(im) #num frames in video
-        corrected_frames = np.zeros_like(im)
-        
-        # Calculate the mean intensity of the first frame
-        i_frame_data = im[0] - min_px_intensity
-        initial_mean_intensity = np.mean(i_frame_data)
-        
-        #bleach correction for each frame
-        for i in range(0, num_frames):
-            frame_data=im[i] - min_px_intensity
-            # Calculate normalization factor relative to the first frame
-            normalization_factor=initial_mean_intensity / np.mean(frame_data)
-            corrected_frames[i] = normalization_factor * frame_data + min_px_intensity
-        return corrected_frames
+    def bleach_correction(file):
+        # Scales every channel of every frame so that its mean intensity above the channel's lowest intensity
+        # matches the first frame's. The per-frame, per-channel means come from one reduction over the movie (one
+        # pass over the frames of a lazy movie); movies in memory are then corrected in place, and lazy ones as
+        # their frames are read, so the movie is never copied.
+        in_place = isinstance(file, np.ndarray) and file.flags.writeable
+        if in_place:
+            means = frame_mean(file, axis=(1, 2))
+            lows = file.min(axis=(0, 1, 2)).astype(np.float64)
+        else:
+            means = np.empty((file.shape[0], file.shape[3]))
+            lows = np.full(file.shape[3], np.inf)
+            for t in range(len(file)):
+                frame = file[t]
+                means[t] = frame_mean(frame, axis=(0, 1))
+                np.minimum(lows, frame.min(axis=(0, 1)), out=lows)
+        above = means - lows
+        # Frames of channels without any intensity above their lowest (in that frame or the first) are left as they are
+        factors = above[0] / np.where(above > 0, above, 1)
+        factors[(above <= 0) | (above[0] <= 0)] = 1
+
+        if in_place:
+            for t in range(len(file)):
+                bleach_correct(file[t], factors[t], lows, file[t])
+            return file
+        read_frame = file.read_frame if isinstance(file, FrameSource) else file.__getitem__
+        return FrameSource(lambda t: bleach_correct(read_frame(t), factors[t], lows, np.empty(file.shape[1:], file.dtype)), file.shape, file.dtype)
 
     
     def convert_to_array(file):
@@ -36,38 +172,74 @@ def read_file(file_path, accept_dim = False):
         num_channels = len(file.metadata['channels'])
         height = file.metadata['height']
         width = file.metadata['width']
-        images = np.zeros((num_images, height, width, num_channels))
 
         if num_images <= 1: # Checks to see if file is z-stack instead of time series
             return None
-        
-        for i in range(num_channels):
-            for j in range(num_images):
-                frame = np.array(file.get_frame_2D(c=i, t=j))
-                images[j, :, :, i] = frame
+
+        images = np.empty((num_images, height, width, num_channels), dtype=np.uint16)
+        start = time.perf_counter()
+        for j in range(num_images):
+            read_nd2_timepoint(file, j, out=images[j])
+        elapsed = time.perf_counter() - start
+        print('Read', num_images, 'frames x', num_channels, 'channels in', round(elapsed, 3), 's (' + str(round(num_images / max(elapsed, 1e-9), 1)), 'frames/s)')
                 
         return images
+
+    def open_nd2(file):
+        num_images = file.sizes['t']
+        num_channels = len(file.metadata['channels'])
+        height = file.metadata['height']
+        width = file.metadata['width']
+
+        if num_images <= 1: # Checks to see if file is z-stack instead of time series
+            return None
+
+        return FrameSource(lambda t: read_nd2_timepoint(file, t), (num_images, height, width, num_channels), np.uint16)
+
+    def open_tiff(file_path):
+        # Uncompressed, contiguous TIFFs are memory-mapped; otherwise pages are decoded one frame at a time
+        import tifffile
+        try:
+            file = tifffile.memmap(file_path, mode='r')
+            return file[..., np.newaxis] if file.ndim == 3 else file
+        except ValueError:
+            pass
+        series = tifffile.TiffFile(file_path).series[0]
+        if len(series.pages) != series.shape[0]:
+            file = series.asarray()
+            return np.reshape(file, (file.shape + (1,))) if len(file.shape) == 3 else file
+        shape = series.shape + (1,) if len(series.shape) == 3 else series.shape
+        return FrameSource(lambda t: np.reshape(series.pages[t].asarray(), shape[1:]), shape, series.dtype)
     
-    if file_path.endswith('.tiff') or file_path.endswith('.tif'):
-        file = iio.imread(file_path)
+    if (file_path.endswith('.tiff') or file_path.endswith('.tif')) and lazy:
+        file = open_tiff(file_path)
+
+    elif file_path.endswith('.tiff') or file_path.endswith('.tif'):
+        import imageio.v3 as iio
+        file = compact_storage(iio.imread(file_path))
         file = np.reshape(file, (file.shape + (1,))) if len(file.shape) == 3 else file
 
     elif file_path.endswith('.nd2'):
+        from nd2reader import ND2Reader
         try:
             file_nd2 = ND2Reader(file_path)
             if file_nd2 == None:
                 return None
         except:
             return None
-        file = convert_to_array(file_nd2)
-        if isinstance(file, np.ndarray) == False:
+        file = open_nd2(file_nd2) if lazy else convert_to_array(file_nd2)
+        if file is None:
             return None
 
-    # file = bleach_correction(file)
+    if correct_bleaching:
+        with stage(recorder, 'bleach_correction'):
+            file = bleach_correction(file)
     
-    if accept_dim == False and check_first_frame_dim(file) == True:
-        print(file_path + 'is too dim, skipping to next file...')
-        return None
+    if accept_dim == False:
+        with stage(recorder, 'dimness_check'):
+            too_dim = check_first_frame_dim(file)
+        if too_dim == True:
+            print(file_path + 'is too dim, skipping to next file...')
+            return None
         
-    else:
-        return file
+    return file
@@ -1,80 +1,122 @@
 from reader import read_file
+import sys
 import numpy as np
-import matplotlib.pyplot as plt
-import imageio.v3 as iio
-from nd2reader import ND2Reader
-import math, pims, yaml, gc, csv, os, glob, pickle
 
-import numpy as np
-from numpy.polynomial import Polynomial
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from frame_stats import FrameMemo, frame_mean
+from kernels import threshold_mask
 
-from skimage import measure, io
-from skimage.measure import label, regionprops
+def binarize(frame, offset_threshold, avg_intensity = None):
+    # Boolean mask of the pixels at or above the offset mean intensity (avg_intensity when already known)
+    if avg_intensity is None:
+        avg_intensity = frame_mean(frame)
+    threshold = avg_intensity * (1 + offset_threshold)
+    new_frame = threshold_mask(frame, threshold)
+    return new_frame
 
-from scipy import ndimage
+def tiled_components(mask, tiler):
+    # Areas of the 8-connected regions of a boolean mask and whether each touches the top, bottom, left and right
+    # edges, as ndimage.label of the whole mask would give them: tiles are labelled separately (in the tiler's
+    # threads) and labels of neighbouring pixels on either side of a tile border are joined afterwards
+    struct = ndimage.generate_binary_structure(2, 2)
+    rows, columns = tiler.spans(mask.shape[0]), tiler.spans(mask.shape[1])
+
+    def label_tile(tile):
+        labeled, num_features = ndimage.label(mask[tile], structure=struct)
+        return num_features, np.bincount(labeled.ravel(), minlength=num_features + 1)[1:], labeled[0].copy(), labeled[-1].copy(), labeled[:, 0].copy(), labeled[:, -1].copy()
+
+    labelled = tiler.map(label_tile, [(row, column) for row in rows for column in columns])
+    # Tile labels are offset to global labels (0 stays background); only the edge rows and columns are kept
+    offsets = np.cumsum([0] + [tile[0] for tile in labelled])
+    def globalise(strip, index):
+        return np.where(strip > 0, strip + offsets[index], 0)
+    areas = np.concatenate([[0]] + [tile[1] for tile in labelled])
+    strips = [[globalise(strip, index) for strip in tile[2:]] for index, tile in enumerate(labelled)]
+    grid = lambda i, j: strips[i * len(columns) + j]
+
+    pairs = []
+    def join(before, after):
+        # Pixels across a border are neighbours when at most one pixel apart along it
+        for shift in (-1, 0, 1):
+            a = before[max(shift, 0):len(before) + min(shift, 0)]
+            b = after[max(-shift, 0):len(after) + min(-shift, 0)]
+            both = (a > 0) & (b > 0)
+            pairs.append(np.stack([a[both], b[both]]))
+    for j in range(len(columns) - 1):
+        join(np.concatenate([grid(i, j)[3] for i in range(len(rows))]), np.concatenate([grid(i, j + 1)[2] for i in range(len(rows))]))
+    for i in range(len(rows) - 1):
+        join(np.concatenate([grid(i, j)[1] for j in range(len(columns))]), np.concatenate([grid(i + 1, j)[0] for j in range(len(columns))]))
+
+    num_labels = len(areas)
+    edges = np.concatenate(pairs, axis=1) if pairs else np.zeros((2, 0), dtype=np.int64)
+    graph = coo_matrix((np.ones(edges.shape[1], dtype=np.int8), (edges[0], edges[1])), shape=(num_labels, num_labels))
+    num_components, component = connected_components(graph, directed=False)
+    component_areas = np.bincount(component, weights=areas, minlength=num_components)
+    component_areas[component[0]] = 0 # Background
+
+    def touching(strip):
+        touches = np.zeros(num_components, dtype=bool)
+        touches[component[strip[strip > 0]]] = True
+        return touches
+    top = touching(np.concatenate([grid(0, j)[0] for j in range(len(columns))]))
+    bottom = touching(np.concatenate([grid(len(rows) - 1, j)[1] for j in range(len(columns))]))
+    left = touching(np.concatenate([grid(i, 0)[2] for i in range(len(rows))]))
+    right = touching(np.concatenate([grid(i, len(columns) - 1)[3] for i in range(len(rows))]))
+    return component_areas, top, bottom, left, right
+
+def check_connected(frame, tiler = None):
+    # Labels a binarized frame once and reports whether a single connected component touches both the top and
+    # bottom edges (axis 0) and whether one touches both the left and right edges (axis 1)
+    if tiler is not None:
+        areas, top, bottom, left, right = tiled_components(frame, tiler)
+        return bool(np.any(top & bottom)), bool(np.any(left & right))
+    struct = ndimage.generate_binary_structure(2, 2)
+
+    frame_connections, num_features = ndimage.label(input=frame, structure=struct)
+    if num_features == 0:
+        return False, False
+
+    def touches_both(first_edge, last_edge):
+        touching = np.zeros(num_features + 1, dtype=bool)
+        touching[first_edge] = True
+        touching[0] = False
+        return touching[last_edge].any()
+
+    return touches_both(frame_connections[0,:], frame_connections[-1,:]), touches_both(frame_connections[:,0], frame_connections[:,-1])
+
+def frames_span(first_frame, last_frame, tiler = None):
+    # Takes binarized frames
+    first_axis0, first_axis1 = check_connected(first_frame, tiler)
+    last_axis0, last_axis1 = check_connected(last_frame, tiler)
+    return (first_axis0 and last_axis0) or (first_axis1 and last_axis1)
 
 def check_span(image, R_thresh):
-    
-    def binarize(frame, offset_threshold):
-        avg_intensity = np.mean(frame)
-        threshold = avg_intensity * (1 + offset_threshold)
-        new_frame = np.where(frame < threshold, 0, 1)
-        return new_frame
-    
-    def check_connected(frame, axis=0):
-        # Ensures that either 
-        if axis == 0:
-            first = (frame[0] == 1).any()
-            last = (frame[len(frame) - 1] == 1).any()
-        elif axis == 1:
-            first = (frame[:,0] == 1).any()
-            last = (frame[:,len(frame[:]) - 1] == 1).any()
-        else:
-            raise Exception("Axis must be 0 or 1.")
-    
-        struct = ndimage.generate_binary_structure(2, 2)
-    
-        frame_connections, num_features = ndimage.label(input=frame, structure=struct)
-    
-        if axis == 0:
-            labeled_first = np.unique(frame_connections[0,:])
-            labeled_last = np.unique(frame_connections[-1,:])
-    
-        if axis == 1:
-            labeled_first = np.unique(frame_connections[:,0])
-            labeled_last = np.unique(frame_connections[:,-1])
-    
-        labeled_first = set(labeled_first[labeled_first != 0])
-        labeled_last = set(labeled_last[labeled_last != 0])
-    
-        if labeled_first.intersection(labeled_last):
-            return True
-        else:
-            return False
-        
-        
     first_frame = binarize(image[0], R_thresh)
     last_frame = binarize(image[-1], R_thresh)
-    return (check_connected(first_frame) and check_connected(last_frame)) or (check_connected(first_frame, axis = 1) and check_connected(last_frame, axis = 1))
+    return frames_span(first_frame, last_frame)
+
+def find_largest_void(frame, tiler = None):
+    # Area of the largest 8-connected region of either phase of a binarized frame (voids and the network alike),
+    # taken from a label count of each phase rather than full regionprops
+    struct = ndimage.generate_binary_structure(2, 2)
+    largest_area = 0
+    for phase in (np.logical_not(frame), frame):
+        if tiler is not None:
+            largest_area = max(largest_area, int(tiled_components(phase, tiler)[0].max()))
+            continue
+        labeled, num_features = ndimage.label(phase, structure=struct)
+        if num_features > 0:
+            largest_area = max(largest_area, int(np.bincount(labeled.ravel())[1:].max()))
+    return largest_area
+
+def find_largest_voids(frames, tiler = None):
+    return [find_largest_void(frame, tiler) for frame in frames]
 
 def track_void(image, threshold, step):
-    def binarize(frame, offset_threshold):
-        avg_intensity = np.mean(frame)
-        threshold = avg_intensity * (1 + offset_threshold)
-        new_frame = np.where(frame < threshold, 0, 1)
-        return new_frame
-        
-    def find_largest_void(frame, find_void = True):      
-        if find_void:
-            frame = np.invert(frame)
-        labeled, a = label(frame, connectivity= 2, return_num =True) # identify the regions of connectivity 2
-        regions = regionprops(labeled) # determines the region properties of the labeled
-        largest_region = max(regions, key = lambda r: r.area) # determines the region with the maximum area
-        return largest_region.area # returns largest region area
-    
-    def find_largest_void_regions(frame):
-        return max(find_largest_void_mid(frame, find_void = True), find_largest_void_mid(frame, find_void = False))
-    
     void_lst = []
     
     for i in range(0, len(image), step):
@@ -83,51 +125,115 @@ def track_void(image, threshold, step):
         void_lst.append(void_area)
     return void_lst
 
-def check_resilience(file, channel, R_offset, percent_threshold_loss, percent_threshold_gain, frame_step, frame_start_percent, frame_stop_percent):
-    #Note for parameters: frame_step (stepsize) used to reduce the runtime. 
-    image = file[:,:,:,channel]
-    frame_initial_percent = 0.05
+class ResilienceAccumulator:
+    # Consumes a channel one frame at a time; only the binarized first and last frames are kept for check_span
+    def __init__(self, num_frames, frame_shape, R_offset, percent_threshold_loss, percent_threshold_gain, frame_step, frame_start_percent, frame_stop_percent, workers = 1, batch_size = 8, span_step = False, stats = None, tiler = None):
+        self.num_frames = num_frames
+        self.frame_shape = frame_shape
+        self.R_offset = R_offset
+        self.percent_threshold_loss = percent_threshold_loss
+        self.percent_threshold_gain = percent_threshold_gain
+        self.frame_step = frame_step
+        self.frame_start_percent = frame_start_percent
+        self.frame_stop_percent = frame_stop_percent
+        self.blank = True
+        self.largest_void_lst = []
+        self.first_frame = None
+        self.last_frame = None
+        # Spanning of every span_step-th frame as [frame, spans axis 0, spans axis 1] (not tracked when False)
+        self.span_step = span_step
+        self.span_series = []
+        # Binarized frames are labelled in batches, across a thread pool when workers > 1
+        self.workers = workers
+        self.batch_size = batch_size
+        self.executor = ThreadPoolExecutor(workers) if workers > 1 else None
+        self.batch = []
+        self.pending = deque()
+        # Frame means and binarized frames are memoized in the file's FrameMemo when shared with other trackers
+        self.stats = stats if stats is not None else FrameMemo().channel(0)
+        # Frames are labelled tile by tile when a tiler is given
+        self.tiler = tiler
 
-    fig, ax = plt.subplots(figsize = (5,5))
+    def binarized(self, t, frame):
+        return self.stats.derived(('binarized', self.R_offset), t, frame, lambda frame: binarize(frame, self.R_offset, self.stats.mean(t, frame)))
 
-    # Error Checking: Empty Image
-    if (image == 0).all():
-        verdict = "Data not available for this channel."
-        return verdict, fig
-    
-    largest_void_lst = track_void(image, R_offset, frame_step)
-    start_index = int(len(largest_void_lst) * frame_start_percent)
-    stop_index = int(len(largest_void_lst) * frame_stop_percent)
-    start_initial_index = int(len(largest_void_lst)*frame_initial_percent)
+    def add(self, t, frame):
+        self.blank = self.blank and not np.any(frame)
+        span_frame = bool(self.span_step) and t % self.span_step == 0
+        if t % self.frame_step != 0 and t != 0 and t != self.num_frames - 1 and not span_frame:
+            return
+        new_frame = self.binarized(t, frame)
+        if span_frame:
+            self.span_series.append([t, *check_connected(new_frame, self.tiler)])
+        if t % self.frame_step == 0:
+            self.batch.append(new_frame)
+            if len(self.batch) == self.batch_size:
+                self.submit_batch()
+        if t == 0:
+            self.first_frame = new_frame
+        if t == self.num_frames - 1:
+            self.last_frame = new_frame
 
-    percent_gain_initial_list = np.mean(largest_void_lst[0:start_initial_index])
-    percent_gain_list = np.array(largest_void_lst)/percent_gain_initial_list
-    
-    ax.plot(np.arange(start_index, stop_index), percent_gain_list[start_index:stop_index])
-    ax.set_xlabel("Frames")
-    ax.set_ylabel("Proportion of orginal void size")
-    #Calculate
-    
-    avg_percent_change = np.mean(largest_void_lst[start_index:stop_index])/percent_gain_initial_list
-    max_void_size = max(largest_void_lst)/(len(image[0,0,:])*len(image[0,:,0]))
-    #print(avg_percent_change)
-    #print("max void size")
-    #print(max_void_size)
-    #Give judgement
-    if avg_percent_change >= percent_threshold_loss and avg_percent_change <= percent_threshold_gain or max_void_size < 0.10:
-        verdict = 1
-    else:
-        verdict = 0
-    
-    max_void_value = int(max_void_size*10)
-    spanning = check_span(image, R_offset)
-    
-    return verdict, fig, max_void_value, spanning
+    def submit_batch(self):
+        if self.executor is None:
+            self.largest_void_lst.extend(find_largest_voids(self.batch, self.tiler))
+        else:
+            self.pending.append(self.executor.submit(find_largest_voids, self.batch, self.tiler))
+            while len(self.pending) > self.workers:
+                self.largest_void_lst.extend(self.pending.popleft().result())
+        self.batch = []
+
+    def result(self):
+        if self.batch:
+            self.submit_batch()
+        while self.pending:
+            self.largest_void_lst.extend(self.pending.popleft().result())
+        if self.executor is not None:
+            self.executor.shutdown()
+
+        frame_initial_percent = 0.05
+
+        # Error Checking: Empty Image
+        if self.blank:
+            verdict = "Data not available for this channel."
+            return verdict, None, None, None
+        
+        largest_void_lst = self.largest_void_lst
+        start_index = int(len(largest_void_lst) * self.frame_start_percent)
+        stop_index = int(len(largest_void_lst) * self.frame_stop_percent)
+        start_initial_index = int(len(largest_void_lst)*frame_initial_percent)
+
+        percent_gain_initial_list = np.mean(largest_void_lst[0:start_initial_index])
+        percent_gain_list = np.array(largest_void_lst)/percent_gain_initial_list
+        
+        plot_data = {'frames': np.arange(start_index, stop_index), 'void_ratio': percent_gain_list[start_index:stop_index]}
+        #Calculate
+        
+        avg_percent_change = np.mean(largest_void_lst[start_index:stop_index])/percent_gain_initial_list
+        max_void_size = max(largest_void_lst)/(self.frame_shape[0]*self.frame_shape[1])
+        #Give judgement
+        if avg_percent_change >= self.percent_threshold_loss and avg_percent_change <= self.percent_threshold_gain or max_void_size < 0.10:
+            verdict = 1
+        else:
+            verdict = 0
+        
+        max_void_value = int(max_void_size*10)
+        spanning = frames_span(self.first_frame, self.last_frame, self.tiler)
+        
+        return verdict, plot_data, max_void_value, spanning
+
+def check_resilience(file, channel, R_offset, percent_threshold_loss, percent_threshold_gain, frame_step, frame_start_percent, frame_stop_percent, workers = 1, batch_size = 8, span_step = False):
+    #Note for parameters: frame_step (stepsize) used to reduce the runtime. 
+    image = file[:,:,:,channel]
+    accumulator = ResilienceAccumulator(len(image), image.shape[1:3], R_offset, percent_threshold_loss, percent_threshold_gain, frame_step, frame_start_percent, frame_stop_percent, workers, batch_size, span_step)
+    for t in range(len(image)):
+        accumulator.add(t, image[t])
+    return accumulator.result()
 
 def main():
     file = read_file(sys.argv[1])
     channel = read_file(sys.argv[2])
-    verdict, fig, void_value, spanning = check_resilience(file, channel)
+    verdict, plot_data, void_value, spanning = check_resilience(file, channel)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,96 @@
+import os, json, hashlib, pickle
+
+# Parameters that only change how a tracker is executed, not its results, and so are left out of cache keys
+execution_keys = ('workers', 'batch_size', 'fft_batch')
+# Bump when a tracker changes its results so that older cache entries are no longer used
+cache_version = 1
+
+class ResultCache:
+    # On-disk cache of tracker outputs, one pickle per (file, channel, tracker, tracker parameters) key. Files are
+    # identified by path, size and modification time, or by a SHA-256 of their content when fingerprint is
+    # 'content' (so moved or copied files still hit). Least recently used entries are evicted above max_size_mb.
+    def __init__(self, cache_dir, fingerprint = 'mtime', max_size_mb = 1024):
+        if fingerprint not in ('mtime', 'content'):
+            raise ValueError("Cache fingerprint must be 'mtime' or 'content'")
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.fingerprint = fingerprint
+        self.max_size = max_size_mb * 1024 * 1024
+        self.stats = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0}
+        self.content_hashes = {}
+
+    def file_id(self, filepath):
+        stat = os.stat(filepath)
+        file_id = [os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns]
+        if self.fingerprint == 'mtime':
+            return file_id
+        if self.content_hashes.get(filepath, (None,))[0] != file_id:
+            digest = hashlib.sha256()
+            with open(filepath, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 24), b''):
+                    digest.update(chunk)
+            self.content_hashes[filepath] = (file_id, digest.hexdigest())
+        return self.content_hashes[filepath][1]
+
+    def key(self, filepath, channel, tracker, parameters):
+        parameters = {name: value for name, value in parameters.items() if name not in execution_keys}
+        description = json.dumps([cache_version, self.file_id(filepath), channel, tracker, parameters], sort_keys=True, default=str)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                value = pickle.load(f)
+            os.utime(self.path(key)) # Marks the entry as recently used
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        return value
+
+    def put(self, key, value):
+        temporary_path = self.path(key) + '.' + str(os.getpid()) + '.tmp'
+        with open(temporary_path, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, self.path(key))
+        self.stats['writes'] += 1
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.pkl'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                self.stats['evictions'] += 1
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+    def merge_stats(self, stats):
+        for name, value in stats.items():
+            self.stats[name] += value
+
+    def report(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        hit_rate = 100 * self.stats['hits'] / lookups if lookups else 0
+        return 'Cache: {hits} hits, {misses} misses ({rate:.0f}% hit rate), {writes} writes, {evictions} evictions'.format(rate=hit_rate, **self.stats)
+
+def open_cache(config_data, root_dir):
+    # Returns None when caching is disabled; the cache lives in .htp_cache under root_dir unless cache_dir is set
+    cache_data = config_data.get('cache_parameters', {})
+    if cache_data.get('enabled', False) != True:
+        return None
+    cache_dir = cache_data.get('cache_dir', False) or os.path.join(root_dir, '.htp_cache')
+    return ResultCache(cache_dir, cache_data.get('fingerprint', 'mtime'), cache_data.get('max_size_mb', 1024))
@@ -0,0 +1,112 @@
+import os, csv, io, hashlib
+import numpy as np
+
+headers = ['Channel', 'Resilience', 'Flow', 'Coarseness', 'Largest void', 'Span', 'Intensity Difference Area']
+
+def write_durably(f, text):
+    # Appends text in a single write and forces it to disk before returning
+    f.write(text)
+    f.flush()
+    os.fsync(f.fileno())
+
+class CsvSummary:
+    # summary.csv written one file at a time as results come in: a row with the file name followed by its channel
+    # rows (with the same header and blank row layout as the original end-of-run writer). When resuming, files
+    # already named in an existing summary are reported as done and new blocks are appended after them.
+    def __init__(self, directory, resume = False):
+        self.path = os.path.join(directory, "summary.csv")
+        self.done = set()
+        if resume and os.path.exists(self.path):
+            with open(self.path, newline='') as csvfile:
+                for row in csv.reader(csvfile):
+                    if len(row) == 1 and row[0]:
+                        self.done.add(row[0])
+        # The original writer only wrote the header row in the first file's block
+        self.headers = [] if self.done else list(headers)
+        self.resume = resume
+        self.file = None
+
+    def is_done(self, name):
+        return name in self.done
+
+    def add(self, name, rfc_data):
+        if self.file is None: # Opened on the first result, so a run without any results leaves summary.csv alone
+            self.file = open(self.path, 'a' if self.resume else 'w', newline='')
+        buffer = io.StringIO()
+        csvwriter = csv.writer(buffer)
+        csvwriter.writerow([name])
+        csvwriter.writerow(self.headers)
+        for entry in rfc_data:
+            csvwriter.writerow(self.headers)
+            self.headers = []
+            csvwriter.writerow(entry)
+        csvwriter.writerow([])
+        write_durably(self.file, buffer.getvalue())
+        self.done.add(name)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+class ParquetSummary:
+    # summary.parquet directory (readable as one table with pyarrow.dataset or pandas.read_parquet) holding one
+    # part per screened file and one row per channel; each part is written to a temporary file and renamed into
+    # place, so an interrupted run leaves only complete parts behind
+    def __init__(self, directory, resume = False):
+        try:
+            import pyarrow, pyarrow.parquet
+        except ImportError:
+            raise ImportError("The parquet summary format needs pyarrow (pip install pyarrow)")
+        self.pa, self.pq = pyarrow, pyarrow.parquet
+        self.path = os.path.join(directory, "summary.parquet")
+        os.makedirs(self.path, exist_ok=True)
+        self.resume = resume
+        if not resume:
+            for entry in os.scandir(self.path):
+                if entry.name.startswith('part-'):
+                    os.remove(entry.path)
+        self.schema = pyarrow.schema([('File', pyarrow.string()), ('Channel', pyarrow.string()), ('Resilience', pyarrow.string()),
+                                      ('Flow', pyarrow.string()), ('Coarseness', pyarrow.string()), ('Largest void', pyarrow.int64()),
+                                      ('Span', pyarrow.bool_()), ('Intensity Difference Area', pyarrow.list_(pyarrow.float64()))])
+        self.done = set()
+
+    def part_path(self, name):
+        return os.path.join(self.path, 'part-' + hashlib.sha1(name.encode()).hexdigest()[:16] + '.parquet')
+
+    def is_done(self, name):
+        return name in self.done or (self.resume and os.path.exists(self.part_path(name)))
+
+    def add(self, name, rfc_data):
+        columns = {field: [] for field in self.schema.names}
+        for channel, r, f, c, void_value, spanning, c_areas in rfc_data:
+            columns['File'].append(name)
+            columns['Channel'].append(str(channel))
+            columns['Resilience'].append(str(r))
+            columns['Flow'].append(str(f))
+            columns['Coarseness'].append(str(c))
+            columns['Largest void'].append(None if void_value is None else int(void_value))
+            columns['Span'].append(None if spanning is None else bool(spanning))
+            columns['Intensity Difference Area'].append(None if c_areas is None else np.asarray(c_areas, dtype=np.float64).tolist())
+        table = self.pa.table(columns, schema=self.schema)
+        temporary_path = self.part_path(name) + '.tmp'
+        with open(temporary_path, 'wb') as f:
+            self.pq.write_table(table, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.part_path(name))
+        self.done.add(name)
+
+    def close(self):
+        pass
+
+def open_summary(config_data, directory, resume = None):
+    # Summary writer chosen by output_parameters; resume overrides the config when given
+    output_data = config_data.get('output_parameters', {})
+    output_format = output_data.get('format', 'csv')
+    if resume is None:
+        resume = output_data.get('resume', False)
+    if output_format == 'csv':
+        return CsvSummary(directory, resume)
+    if output_format == 'parquet':
+        return ParquetSummary(directory, resume)
+    raise ValueError("Summary format must be 'csv' or 'parquet'")
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+from scipy.fft import fft2, ifft2
+from flow_tracker import FlowAccumulator, findRoot, flow_backends
+
+def shifted_pair(dy, dx, size = 256, smoothing = 3, seed = 0):
+    # Two uint16 frames of a smooth random texture, the second moved by (dy, dx) pixels
+    texture = ndimage.gaussian_filter(np.random.default_rng(seed).standard_normal((size + 64, size + 64)), smoothing, mode='wrap')
+    first = texture[32:32 + size, 32:32 + size]
+    second = np.roll(texture, (dy, dx), axis=(0, 1))[32:32 + size, 32:32 + size]
+    return np.uint16(first * 1000 + 3000), np.uint16(second * 1000 + 3000)
+
+@pytest.mark.parametrize('backend', sorted(flow_backends))
+@pytest.mark.parametrize('downsample', [1, 4, 8])
+@pytest.mark.parametrize('shift', [(0, 4), (2, 6), (-3, 5)])
+def test_backends_recover_a_rigid_shift(backend, downsample, shift):
+    first, second = shifted_pair(*shift)
+    flow = flow_backends[backend](first, second, downsample)
+    assert flow.shape == (-(-first.shape[0] // downsample), -(-first.shape[1] // downsample), 2)
+    # Flow is (x, y) displacement
+    np.testing.assert_allclose(np.median(flow.reshape(-1, 2), axis=0), [shift[1], shift[0]], atol=0.25)
+
+@pytest.mark.parametrize('downsample', [1, 4, 8])
+def test_phase_correlation_peaks_are_not_pulled_to_zero(downsample):
+    first, second = shifted_pair(2, 6, smoothing=6)
+    flow = flow_backends['phase_correlation'](first, second, downsample)
+    # Blocks reaching past the frame edge see reflected texture that did not move, so only the interior counts
+    margin = -(-32 // downsample)
+    interior = flow[margin:-margin, margin:-margin]
+    assert np.mean(np.all(np.abs(interior - [6, 2]) < 0.5, axis=-1)) > 0.95
+
+def reference_corr_len(flow, downsample, pix_size, bin_width, decay_threshold = 1/np.exp(1)):
+    # Correlation length of one frame pair's flow field (sampled every downsample pixels) as the flow tracker
+    # computed it before it was vectorised: one direction and one radius per pixel, one mask per annulus. The
+    # autocorrelation is taken in double precision, as the tracker now does.
+    def normalize(vector):
+        magnitude = np.linalg.norm(vector)
+        if magnitude == 0: return np.array([0,0])
+        return np.where(magnitude > 1e-10, np.array(vector)/magnitude, np.array([0, 0]))
+
+    directions = np.zeros_like(flow)
+    for i in range(0, flow.shape[0]):
+        for j in range(0, flow.shape[1]):
+            directions[i][j] = normalize(flow[i][j])
+
+    xindices = np.arange(0, flow.shape[0] * downsample, downsample)
+    yindices = np.arange(0, flow.shape[1] * downsample, downsample)
+    radii = np.zeros((len(xindices),len(yindices)))
+    for i in range(0,len(xindices)):
+        for j in range(0,len(yindices)):
+            radii[i][j] = np.sqrt(xindices[i]**2 + yindices[j]**2)
+
+    directions = directions.astype(np.float64)
+    xFFT = fft2(directions[:,:,0])
+    xConv = np.real(ifft2(np.multiply(xFFT,np.conjugate(xFFT))))
+    yFFT = fft2(directions[:,:,1])
+    yConv = np.real(ifft2(np.multiply(yFFT,np.conjugate(yFFT))))
+    convSum = np.add(xConv,yConv)
+    means = np.array([])
+    inRadii = np.array([])
+    pixel_bin_width = np.ceil(bin_width / pix_size)
+    for i in range(0,int(np.rint(500 / pix_size)),int(pixel_bin_width)):
+            inBin = convSum[(radii > i -.5*pixel_bin_width)&(radii < i + .5*pixel_bin_width)]
+            if(len(inBin) > 0):
+                    inRadii = np.append(inRadii, i)
+                    means = np.append(means, inBin.mean()/convSum[0,0])
+    try:
+        return pix_size*findRoot(inRadii,means,decay_threshold)
+    except ValueError:
+        return 0
+
+def smooth_flow(shape, smoothing, seed):
+    # float32 (x, y) flow field of smoothly varying directions, with a patch of zero vectors
+    rng = np.random.default_rng(seed)
+    flow = np.stack([ndimage.gaussian_filter(rng.standard_normal(shape), smoothing, mode='wrap') for _ in range(2)], axis=-1)
+    flow[:shape[0] // 8, :shape[1] // 8] = 0
+    return flow.astype(np.float32)
+
+@pytest.mark.parametrize('frame_shape, downsample', [((512, 512), 1), ((512, 640), 4), ((768, 512), 8)])
+@pytest.mark.parametrize('pix_size, bin_width', [(1, 1), (1.3, 2)])
+def test_corr_lens_match_the_per_pixel_implementation(frame_shape, downsample, pix_size, bin_width):
+    grid = (-(-frame_shape[0] // downsample), -(-frame_shape[1] // downsample))
+    # Directions vary over 8 to 32 pixels of the frame
+    fields = [smooth_flow(grid, smoothing / downsample, seed) for seed, smoothing in enumerate([8, 16, 32])]
+    accumulator = FlowAccumulator(len(fields) + 1, frame_shape, 25, 0.5, 1, downsample, pix_size, bin_width, fft_batch=2)
+    # Each frame holds its index, which picks the flow field of the pair it starts
+    accumulator.backend = lambda first, second, downsample: fields[first[0, 0]]
+    for t in range(len(fields) + 1):
+        accumulator.add(t, np.full(frame_shape, t, dtype=np.uint16))
+    accumulator.result()
+
+    expected = [reference_corr_len(flow, downsample, pix_size, bin_width) for flow in fields]
+    assert all(expected)
+    np.testing.assert_allclose(accumulator.corrLens, expected, rtol=1e-8)
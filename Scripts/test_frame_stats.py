@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+from scipy.stats import mode
+from frame_stats import intensity_histogram, mean_mode
+
+@pytest.mark.parametrize('dtype', ['uint8', 'uint16', 'int16', 'int32', 'int64', 'float32', 'float64'])
+@pytest.mark.parametrize('low', [0, -40, 7])
+def test_mean_mode_matches_scipy(dtype, low):
+    if low < 0 and np.dtype(dtype).kind == 'u':
+        pytest.skip('unsigned frames have no negative values')
+    # Integer-valued frame with a dark corner at its lowest value
+    rng = np.random.default_rng(0)
+    frame = (low + rng.integers(0, 200, (64, 80))).astype(dtype)
+    frame[:8, :8] = low
+    histogram = intensity_histogram(frame)
+    assert histogram is not None
+    mean_intensity, mode_intensity = mean_mode(frame, histogram)
+    assert mode_intensity == mode(frame.ravel(), keepdims=False).mode
+    assert mode_intensity.dtype == frame.dtype
+    np.testing.assert_allclose(mean_intensity, np.mean(frame), rtol=1e-6)
+
+def test_true_floats_fall_back_to_scipy():
+    frame = np.random.default_rng(0).random((32, 32)).astype(np.float32)
+    frame[0, :4] = 0.5
+    assert intensity_histogram(frame) is None
+    assert mean_mode(frame, None)[1] == np.float32(0.5)
@@ -0,0 +1,36 @@
+import threading
+import numpy as np
+import pytest
+import kernels
+
+pytestmark = pytest.mark.skipif(not kernels.use_numba, reason='numba is not installed')
+
+def run_kernels():
+    # Every kernel on random inputs, large enough for summation order to show in the last bits
+    rng = np.random.default_rng(0)
+    velocities = rng.standard_normal((300, 200, 2)).astype(np.float32)
+    velocities[:5] = 0
+    values = rng.standard_normal((512, 384))
+    bins = rng.integers(-1, 300, values.size)
+    frame = rng.integers(0, 4000, (256, 320)).astype(np.uint16)
+    movie_frame = rng.integers(100, 4000, (64, 48, 2)).astype(np.uint16)
+    return [kernels.normal_vectors(velocities, 1e-10),
+            kernels.radial_sums(values, bins, 300),
+            kernels.radial_sums(values.astype(np.float32), bins, 300),
+            kernels.threshold_mask(frame, 2000.5),
+            kernels.threshold_mask(frame[::2, 1::3], 100.0),
+            kernels.bleach_correct(movie_frame, np.array([1.37, 0.8]), np.array([100.0, 50.0]), np.empty_like(movie_frame)),
+            kernels.bleach_correct(movie_frame.astype(np.float64), np.array([1.37, 0.8]), np.array([100.0, 50.0]), np.empty(movie_frame.shape))]
+
+def test_compiled_kernels_are_bit_identical_to_numpy(monkeypatch):
+    compiled = run_kernels()
+    # The serial builds, as run from other threads
+    serial = []
+    thread = threading.Thread(target=lambda: serial.append(run_kernels()))
+    thread.start()
+    thread.join()
+    monkeypatch.setattr(kernels, 'use_numba', False)
+    for compiled_result, serial_result, numpy_result in zip(compiled, serial[0], run_kernels()):
+        assert compiled_result.dtype == numpy_result.dtype
+        np.testing.assert_array_equal(compiled_result, numpy_result)
+        np.testing.assert_array_equal(serial_result, numpy_result)
@@ -0,0 +1,18 @@
+import os
+import numpy as np
+from benchmark import synthetic_movie
+from flow_tracker import check_flow
+from plotter import render_channel, submit_render
+
+def test_quivers_of_non_square_frames_are_saved(tmp_path):
+    movie = synthetic_movie(frames=6, height=96, width=160, channels=1)
+    flow_plot = check_flow(movie, 0, 25, 0.5, 1, 8, 1, 1)[1]
+    prefix = str(tmp_path / 'movie_channel0')
+    render_channel(prefix + '_graphs.png', prefix, None, flow_plot, None)
+    assert sorted(os.listdir(tmp_path)) == ['movie_channel0_0.png', 'movie_channel0_3.png', 'movie_channel0_4.png', 'movie_channel0_graphs.png']
+
+def test_render_errors_do_not_fail_the_file(tmp_path, capsys):
+    flow_plot = {'corrLens': np.zeros(3), 'quivers': [{'pos': 0, 'x': np.arange(3), 'y': np.arange(4), 'u': np.zeros((3, 4)), 'v': np.zeros((3, 4))}]}
+    prefix = str(tmp_path / 'movie_channel0')
+    submit_render(prefix + '_graphs.png', prefix, None, flow_plot, None)
+    assert 'Rendering failed:' in capsys.readouterr().out
@@ -0,0 +1,54 @@
+import os
+import numpy as np
+import pytest
+import yaml
+from benchmark import synthetic_movie, write_movie
+from main import execute_htp
+from reader import read_file
+from flow_tracker import flow_backends
+
+@pytest.fixture
+def config_data():
+    with open(os.path.join(os.path.dirname(__file__), 'config.yaml')) as f:
+        config_data = yaml.safe_load(f)
+    config_data['reader'].update({'verbose': False, 'accept_dim_images': True, 'channel_select': -1, 'resilience': True, 'flow': True, 'coarsening': True})
+    return config_data
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_saved_dtype_does_not_change_results(tmp_path, config_data, lazy):
+    # The same integer intensities saved as uint16, int32, float32 and float64 screen identically, eagerly read or not
+    movie = synthetic_movie(frames=12, height=128, width=128)
+    config_data['reader']['lazy_loading'] = lazy
+    rows, flows = {}, {}
+    for dtype in ('uint16', 'int32', 'float32', 'float64'):
+        path = str(tmp_path / (dtype + '.tif'))
+        write_movie(movie.astype(dtype), path)
+        rows[dtype] = execute_htp(path, config_data)
+        # The verdicts alone would hide small changes to the optical flow
+        file = read_file(path, True, lazy)
+        flows[dtype] = [flow_backends[backend](np.asarray(file[0])[:, :, 0], np.asarray(file[1])[:, :, 0], 4) for backend in sorted(flow_backends)]
+    assert len(rows['uint16']) == 2
+    for dtype in ('int32', 'float32', 'float64'):
+        np.testing.assert_equal(rows[dtype], rows['uint16'])
+        for flow, uint16_flow in zip(flows[dtype], flows['uint16']):
+            np.testing.assert_array_equal(flow, uint16_flow)
+
+@pytest.mark.parametrize('use_numba', [False, True])
+@pytest.mark.parametrize('lazy', [False, True])
+def test_bleach_correction_matches_a_float_reference(tmp_path, monkeypatch, use_numba, lazy):
+    # Movies in memory are corrected in place, lazy ones as their frames are read
+    import kernels
+    monkeypatch.setattr(kernels, 'use_numba', use_numba and kernels.use_numba)
+    movie = synthetic_movie(frames=12, height=96, width=80)
+    movie = np.uint16(np.round((movie - 100) * np.exp(-0.05 * np.arange(12))[:, None, None, None] + 100))
+    path = str(tmp_path / 'bleached.tif')
+    write_movie(movie, path)
+    corrected = np.asarray(read_file(path, True, lazy, correct_bleaching=True))
+    assert corrected.dtype == np.uint16
+
+    lows = movie.min(axis=(0, 1, 2)).astype(np.float64)
+    above = movie.mean(axis=(1, 2)) - lows
+    expected = (above[0] / above)[:, None, None, :] * (movie - lows) + lows
+    np.testing.assert_allclose(corrected, expected, rtol=0, atol=0.5 + 1e-6)
+    # Rounded, not truncated
+    assert abs(np.mean(corrected - expected)) < 0.01
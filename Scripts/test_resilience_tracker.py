@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+from benchmark import synthetic_movie
+from resilience_tracker import ResilienceAccumulator, check_connected, find_largest_void, tiled_components
+from tiling import Tiler
+
+def random_masks():
+    # Masks of either phase dominating, near the percolation threshold and blank or full, on odd-sized frames
+    rng = np.random.default_rng(0)
+    masks = [rng.random(shape) < density for shape in [(37, 53), (64, 64), (1, 40), (29, 1)] for density in (0.2, 0.45, 0.6, 0.8)]
+    masks += [ndimage.gaussian_filter(rng.standard_normal((70, 45)), 2) > 0 for _ in range(4)]
+    return masks + [np.zeros((16, 24), dtype=bool), np.ones((16, 24), dtype=bool)]
+
+@pytest.mark.parametrize('tile_size, overlap, workers', [(1, 0, 1), (2, 0, 1), (5, 3, 1), (16, 0, 2), (17, 0, 1), (100, 0, 1)])
+def test_tiled_labelling_matches_whole_frame(tile_size, overlap, workers):
+    tiler = Tiler(tile_size, overlap, workers)
+    struct = ndimage.generate_binary_structure(2, 2)
+    for mask in random_masks():
+        assert find_largest_void(mask, tiler) == find_largest_void(mask)
+        assert check_connected(mask, tiler) == check_connected(mask)
+
+        areas, top, bottom, left, right = tiled_components(mask, tiler)
+        labeled, num_features = ndimage.label(mask, structure=struct)
+        expected_areas = np.bincount(labeled.ravel(), minlength=num_features + 1)[1:]
+        # Every component's area and edge contacts, as whole-frame labelling gives them
+        def touching(edge):
+            touches = np.zeros(num_features + 1, dtype=bool)
+            touches[edge] = True
+            return touches[1:]
+        expected = sorted(zip(expected_areas, touching(labeled[0]), touching(labeled[-1]), touching(labeled[:, 0]), touching(labeled[:, -1])))
+        found = sorted((area, *edges) for area, *edges in zip(areas, top, bottom, left, right) if area > 0)
+        assert found == expected
+    tiler.close()
+
+def reference_largest_voids(image, threshold, step):
+    # largest_void_lst as the resilience tracker computed it with skimage: frames binarized to int64 0/1 and
+    # inverted to -2/-1, which label takes as two foreground values, so it is the largest region of either phase
+    from skimage.measure import label, regionprops
+    def binarize(frame, offset_threshold):
+        avg_intensity = np.mean(frame)
+        threshold = avg_intensity * (1 + offset_threshold)
+        new_frame = np.where(frame < threshold, 0, 1)
+        return new_frame
+
+    def find_largest_void(frame, find_void = True):
+        if find_void:
+            frame = np.invert(frame)
+        labeled, a = label(frame, connectivity= 2, return_num =True) # identify the regions of connectivity 2
+        regions = regionprops(labeled) # determines the region properties of the labeled
+        largest_region = max(regions, key = lambda r: r.area) # determines the region with the maximum area
+        return largest_region.area # returns largest region area
+
+    return [find_largest_void(binarize(image[i], threshold)) for i in range(0, len(image), step)]
+
+@pytest.mark.parametrize('dtype', ['uint16', 'float64'])
+@pytest.mark.parametrize('offset, frame_step', [(0, 1), (0.1, 3), (-0.2, 2)])
+@pytest.mark.parametrize('workers, batch_size', [(1, 8), (3, 2)])
+def test_largest_voids_match_the_regionprops_implementation(dtype, offset, frame_step, workers, batch_size):
+    image = synthetic_movie(frames=60, height=96, width=112, channels=1, dtype=dtype)[..., 0]
+    accumulator = ResilienceAccumulator(len(image), image.shape[1:], offset, 0.9, 1.1, frame_step, 0.2, 0.8, workers, batch_size)
+    for t in range(len(image)):
+        accumulator.add(t, image[t])
+    accumulator.result()
+    assert accumulator.largest_void_lst == reference_largest_voids(image, offset, frame_step)
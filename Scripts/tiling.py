@@ -0,0 +1,54 @@
+from concurrent.futures import ThreadPoolExecutor
+
+class Tiler:
+    # Splits frames into tiles of tile_size x tile_size pixels (the last row and column of tiles may be smaller),
+    # each with a halo of overlap extra pixels on every side for trackers that need to see past the tile border,
+    # and maps work over the tiles of a frame in a thread pool when workers > 1
+    def __init__(self, tile_size, overlap = 0, workers = 1):
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.executor = ThreadPoolExecutor(workers) if workers > 1 else None
+
+    def spans(self, length, step = 1):
+        # Tile extents along one axis; with step, the tile size is rounded up to a multiple of it
+        size = -(-self.tile_size // step) * step
+        return [slice(start, min(start + size, length)) for start in range(0, length, size)]
+
+    def tiles(self, shape, step = 1):
+        # (tile, halo) pairs of (rows, columns) slices, row by row; with step, every tile and halo starts at a
+        # multiple of it, so a grid sampled every step pixels lines up between the tiles and the whole frame
+        overlap = -(-self.overlap // step) * step
+        def halo(span, length):
+            return slice(max(span.start - overlap, 0), min(span.stop + overlap, length))
+        return [((rows, columns), (halo(rows, shape[0]), halo(columns, shape[1])))
+                for rows in self.spans(shape[0], step) for columns in self.spans(shape[1], step)]
+
+    def map(self, function, items):
+        if self.executor is None:
+            return [function(item) for item in items]
+        return list(self.executor.map(function, items))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+def open_tiler(config_data):
+    # Returns None when tiling is disabled
+    tiling_data = config_data.get('tiling_parameters', {})
+    if not tiling_data.get('tile_size', False):
+        return None
+    return Tiler(tiling_data['tile_size'], tiling_data.get('overlap', 0), tiling_data.get('workers', 1))
+
+def roi_regions(config_data, frame_shape):
+    # (label suffix, (rows, columns) slices) of every region of interest, given as [top, left, bottom, right] in
+    # pixels; a single unnamed region covering the whole frame when none are set
+    rois = config_data.get('tiling_parameters', {}).get('rois', False)
+    if not rois:
+        return [('', (slice(None), slice(None)))]
+    regions = []
+    for index, roi in enumerate(rois):
+        top, left, bottom, right = [int(value) for value in roi]
+        if not (0 <= top < bottom <= frame_shape[0] and 0 <= left < right <= frame_shape[1]):
+            raise ValueError("Region of interest " + str(roi) + " is not inside the " + str(frame_shape[0]) + " x " + str(frame_shape[1]) + " frame")
+        regions.append(('_roi' + str(index), (slice(top, bottom), slice(left, right))))
+    return regions